@@ -0,0 +1,133 @@
+"""
+Compares the float32 pipeline with the float64 one on the maps in data/: the baseline-corrected
+  intensities, which spectra pass the signal-to-noise filter, and every fitted statistic (peak
+  locations, full width at half maximum and peak ratios) of the spectra both keep, for each fitting
+  method
+
+Differences above the tolerances are reported and make the script exit with status 1, run from the
+  repository root, i.e.
+
+	python benchmarks/accuracy.py --output accuracy.json
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from raman.config import GRAPHENE
+from raman.memo import fit_memo
+from raman.ramanmap import GrapheneRamanMap
+
+METHODS = ["curve_fit", "batch", "joint"]
+
+# largest accepted difference of each statistic between float32 and float64, absolute for peak
+#  locations and widths (cm^-1) and relative for ratios
+TOLERANCES = {"peak_loc": 0.01, "fwhm": 0.01, "ratio": 1e-4}
+
+def tolerance(statistic, tolerances):
+	"""
+	Tolerance of a statistic and whether it is relative
+
+	Parameters
+	----------
+	statistic: name of the statistic (i.e. peak_loc_g)
+	tolerances: dictionary of tolerances by statistic prefix (see TOLERANCES)
+	"""
+
+	prefix = statistic.rsplit("_", 1)[0]
+	return tolerances[prefix], prefix == "ratio"
+
+def compare_map(fpath, methods, thresh, tolerances):
+	"""
+	Analyses a map in float64 and in float32 and compares the results
+
+	Parameters
+	----------
+	fpath: file path to map data
+	methods: fitting methods to compare (see RamanMap.fit_peaks)
+	thresh: signal-to-noise threshold
+	tolerances: dictionary of tolerances by statistic prefix (see TOLERANCES)
+
+	Returns
+	----------
+	list of result dictionaries, one per method and statistic
+	"""
+
+	maps = {dtype: GrapheneRamanMap(fpath, GRAPHENE, cache=False, store=False, dtype=dtype)
+			for dtype in [np.float64, np.float32]}
+	ref, low = maps[np.float64], maps[np.float32]
+
+	scale = np.max(np.abs(ref.intensities))
+	intensity_error = float(np.max(np.abs(ref.intensities - low.intensities)) / scale)
+	print(f"  intensities {ref.intensities.nbytes / 2**20:.1f} MB -> {low.intensities.nbytes / 2**20:.1f} MB, "
+			f"max error {intensity_error:.1e} of the largest intensity")
+
+	results = []
+	for method in methods:
+		for m in maps.values():
+			m.data_summary(thresh, method=method, workers=1, refit=True)
+
+		sc_ref, sc_low = ref.spectra_characteristics, low.spectra_characteristics
+		both = sc_ref["present"] & sc_low["present"]
+		changed = int(np.sum(sc_ref["present"] != sc_low["present"]))
+		print(f"  {method}: {int(np.sum(both))} spectra compared, {changed} filtered differently")
+
+		for statistic in ref.statistics:
+			tol, relative = tolerance(statistic, tolerances)
+			diff = np.abs(sc_ref[statistic][both] - sc_low[statistic][both])
+			if relative:
+				diff = diff / np.abs(sc_ref[statistic][both])
+			max_error = float(np.max(diff)) if len(diff) else 0.0
+			ok = max_error <= tol
+			print(f"    {statistic:<12} max {max_error:9.2e} median {float(np.median(diff)) if len(diff) else 0:9.2e}"
+					f" ({'relative' if relative else 'cm^-1'}, tolerance {tol:.0e}) {'' if ok else 'EXCEEDED'}")
+			results.append({"map": os.path.basename(fpath),
+					"method": method,
+					"statistic": statistic,
+					"compared": int(np.sum(both)),
+					"filtered_differently": changed,
+					"max_error": max_error,
+					"median_error": float(np.median(diff)) if len(diff) else 0.0,
+					"relative": relative,
+					"tolerance": tol,
+					"intensity_error": intensity_error,
+					"ok": ok})
+	return results
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Compare the float32 pipeline with float64")
+	parser.add_argument("--maps", nargs="+", default=[os.path.join(ROOT, "data", "small_map.csv"),
+			os.path.join(ROOT, "data", "large_map.csv")], help="map files to compare on")
+	parser.add_argument("--methods", nargs="+", default=METHODS, choices=METHODS, help="fitting methods")
+	parser.add_argument("--snr", type=float, default=15, help="signal-to-noise threshold (default 15)")
+	for prefix, tol in TOLERANCES.items():
+		parser.add_argument(f"--{prefix.replace('_', '-')}-tolerance", type=float, default=tol,
+				help=f"largest accepted {prefix} difference (default {tol:g})")
+	parser.add_argument("--output", default=None, help="path of the JSON results (default printed only)")
+	args = parser.parse_args(argv)
+
+	# memoized fits of the float64 map would otherwise be reused for identical float32 windows
+	fit_memo.enabled = False
+	tolerances = {prefix: getattr(args, f"{prefix}_tolerance") for prefix in TOLERANCES}
+
+	results = []
+	for fpath in args.maps:
+		print(os.path.basename(fpath))
+		results.extend(compare_map(fpath, args.methods, args.snr, tolerances))
+
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(results, f, indent=4)
+		print(f"Results saved to {args.output}")
+
+	return 0 if all(r["ok"] for r in results) else 1
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,316 @@
+"""
+Benchmarks every stage of the map pipeline (parsing, baseline removal, signal-to-noise, peak fitting,
+  heatmap rendering, histogram and summary statistics output) on the maps in data/ and on synthetic
+  maps scaled up from them, recording wall time and peak memory of each stage as JSON
+
+Run from the repository root, i.e.
+
+	python benchmarks/bench.py --scales 1 10 --output bench.json
+	python benchmarks/bench.py --scales 1 10 --output new.json --compare bench.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from raman.config import GRAPHENE
+from raman.heatmap import HeatMap
+from raman.labspec import read_labspec
+from raman.material import MaterialIndex
+from raman.memo import fit_memo
+from raman.ramanmap import GrapheneRamanMap
+from raman.utils import remove_baseline
+
+STAGES = ["parse", "baseline", "snr", "init", "fit", "heatmap", "histogram", "stats"]
+
+# peak location (cm^-1), half width (cm^-1) and relative height of the synthetic graphene peaks
+SYNTHETIC_PEAKS = {"D": (1350, 20, 0.3), "G": (1580, 10, 1.0), "2D": (2690, 18, 0.6)}
+
+def peak_shape(x, x_0, gamm, shape, eta=0.5):
+	"""
+	Unit height peak of the given shape
+
+	Parameters
+	----------
+	x: wavenumbers
+	x_0: location of the peak
+	gamm: half width at half maximum
+	shape: 'lorentzian', 'gaussian' or 'pseudo-voigt'
+	eta: Lorentzian fraction of the pseudo-Voigt peak
+	"""
+
+	lor = gamm**2 / ((x - x_0)**2 + gamm**2)
+	gau = np.exp(-np.log(2) * ((x - x_0) / gamm)**2)
+	if shape == "lorentzian":
+		return lor
+	elif shape == "gaussian":
+		return gau
+	elif shape == "pseudo-voigt":
+		return eta * lor + (1 - eta) * gau
+	raise ValueError("Invalid shape, must be 'lorentzian', 'gaussian' or 'pseudo-voigt'")
+
+def synthetic_map(fpath, wavenums, n_spectra, noise=5.0, amplitude=400.0, shape="lorentzian",
+		empty_fraction=0.1, seed=0):
+	"""
+	Writes a synthetic graphene map in LabSpec .csv format on a square-ish grid, with peak heights
+	  and locations varying smoothly across the map, a curved baseline and Gaussian noise
+
+	Parameters
+	----------
+	fpath: path of the .csv file to write
+	wavenums: wavenumber axis of every spectrum
+	n_spectra: number of spectra (pixels) of the map
+	noise: standard deviation of the noise
+	amplitude: height of the G peak
+	shape: peak shape, 'lorentzian', 'gaussian' or 'pseudo-voigt'
+	empty_fraction: fraction of pixels holding only baseline and noise (they are filtered out)
+	seed: random seed
+	"""
+
+	rng = np.random.default_rng(seed)
+	cols = int(np.ceil(np.sqrt(n_spectra)))
+	pos = np.arange(n_spectra)
+	x = (pos % cols) * 0.5
+	y = (pos // cols) * 0.5
+
+	# smooth spatial variation of heights and locations
+	phase = np.sin(x / max(np.max(x), 1) * np.pi) * np.cos(y / max(np.max(y), 1) * np.pi)
+	empty = rng.random(n_spectra) < empty_fraction
+
+	w = (wavenums - np.min(wavenums)) / np.ptp(wavenums)
+	with open(fpath, "w") as f:
+		f.write(",," + ",".join(f"{i:g}" for i in wavenums) + "\n")
+		for start in range(0, n_spectra, 1024):
+			s = slice(start, start + 1024)
+			n = len(pos[s])
+			spectra = (100 + 80 * w + 60 * w**2) * (1 + 0.2 * rng.random((n, 1)))
+			for loc, gamm, height in SYNTHETIC_PEAKS.values():
+				spectra += (amplitude * height * (1 + 0.3 * phase[s, None]) * ~empty[s, None]
+						* peak_shape(wavenums, loc + 5 * phase[s, None], gamm, shape))
+			spectra += rng.normal(0, noise, spectra.shape)
+			for xi, yi, row in zip(x[s], y[s], spectra):
+				f.write(f"{xi:g},{yi:g}," + ",".join(f"{i:.2f}" for i in row) + "\n")
+
+def measure(func, repeat, memory=True):
+	"""
+	Times a function and records its peak memory use (traced Python and numpy allocations of this
+	  process, so worker processes are not included)
+
+	Tracing slows down Python code considerably, so the timed runs are not traced and the memory
+	  is measured by one extra run
+
+	Parameters
+	----------
+	func: function to call
+	repeat: number of timed calls
+	memory: whether to measure peak memory
+
+	Returns
+	----------
+	dictionary of timings and peak memory, and the result of the last call
+	"""
+
+	times = []
+	for i in range(repeat):
+		t = time.perf_counter()
+		result = func()
+		times.append(time.perf_counter() - t)
+
+	peak = None
+	if memory:
+		tracemalloc.start()
+		result = func()
+		peak = tracemalloc.get_traced_memory()[1] / 2**20
+		tracemalloc.stop()
+
+	return {"seconds": min(times), 
+			"median_seconds": float(np.median(times)), 
+			"runs": repeat,
+			"peak_mb": peak}, result
+
+def bench_map(fpath, stages, repeat, workers, memory=True):
+	"""
+	Benchmarks the selected stages on a single map
+
+	Parameters
+	----------
+	fpath: file path to map data
+	stages: list of stages to run (see STAGES)
+	repeat: number of runs per stage (the fastest is reported)
+	workers: number of processes used for fitting
+	memory: whether to measure the peak memory of each stage
+
+	Returns
+	----------
+	list of result dictionaries, one per stage
+	"""
+
+	results = []
+
+	def record(stage, func, n):
+		if stage not in stages:
+			return None
+		r, value = measure(func, repeat, memory)
+		r.update({"stage": stage, "spectra_per_second": n / r["seconds"] if r["seconds"] else None})
+		results.append(r)
+		print(f"  {stage:<10} {r['seconds']:9.4f} s" + (f" {r['peak_mb']:9.1f} MB" if memory else ""))
+		return value
+
+	# the stages are also run individually so their cost can be told apart from RamanMap.__init__
+	wavenums, x, y, raw = read_labspec(fpath)
+	n = len(raw)
+	record("parse", lambda: read_labspec(fpath), n)
+	corrected = record("baseline", lambda: remove_baseline(raw), n)
+	if corrected is None:
+		corrected = remove_baseline(raw)
+	index = MaterialIndex(wavenums, GRAPHENE)
+	record("snr", lambda: index.signal_noise_ratio(corrected), n)
+
+	# saved results are not used, so every run fits every spectrum
+	rmap = record("init", lambda: GrapheneRamanMap(fpath, GRAPHENE, cache=False, store=False), n)
+	if rmap is None:
+		rmap = GrapheneRamanMap(fpath, GRAPHENE, cache=False, store=False)
+
+	def fit():
+		# every run fits every spectrum
+		rmap.data_summary(15, workers=workers, refit=True)
+
+	record("fit", fit, n)
+	if "fit" not in stages:
+		fit()
+
+	def heatmap():
+		h = HeatMap(rmap, "ratio_2dg", "2D:G Ratio", gradient=100)
+		h.gradient = 50
+		h.calc_img()
+		return h
+
+	record("heatmap", heatmap, n)
+
+	with tempfile.TemporaryDirectory() as d:
+		record("histogram", lambda: [rmap.create_histogram(s, s, os.path.join(d, f"{s}.png"))
+				for s in rmap.statistics], n)
+		record("stats", lambda: rmap.category_statistics(os.path.join(d, "statistics.csv")), n)
+
+	for r in results:
+		r.update({"map": os.path.basename(fpath), "spectra": n, "wavenumbers": len(wavenums)})
+	return results
+
+def git_commit():
+	"""
+	Hash of the checked out commit (None outside a git repository)
+	"""
+
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+				cwd=ROOT,
+				capture_output=True,
+				text=True,
+				check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare(results, baseline, threshold):
+	"""
+	Prints the stages that got slower than in a previous benchmark by more than the threshold
+
+	Parameters
+	----------
+	results: result dictionaries of this run
+	baseline: result dictionaries of the previous run
+	threshold: relative slowdown to report (i.e. 0.2 for 20 %)
+
+	Returns
+	----------
+	number of regressions
+	"""
+
+	old = {(r["map"], r["stage"]): r for r in baseline}
+	regressions = 0
+	for r in results:
+		o = old.get((r["map"], r["stage"]))
+		if not o or not o["seconds"]:
+			continue
+		change = r["seconds"] / o["seconds"] - 1
+		flag = "REGRESSION" if change > threshold else ""
+		regressions += bool(flag)
+		print(f"{r['map']:<32} {r['stage']:<10} {o['seconds']:9.4f} -> {r['seconds']:9.4f} s "
+				f"({change:+.0%}) {flag}")
+	return regressions
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark the Raman map pipeline stage by stage")
+	parser.add_argument("--maps", nargs="+", default=[os.path.join(ROOT, "data", "small_map.csv"),
+			os.path.join(ROOT, "data", "large_map.csv")], help="map files to benchmark")
+	parser.add_argument("--scales", nargs="*", type=int, default=[10],
+			help="pixel count multiples of the first map for synthetic maps (i.e. 10 100)")
+	parser.add_argument("--noise", type=float, default=5.0, help="noise standard deviation of synthetic maps")
+	parser.add_argument("--amplitude", type=float, default=400.0, help="G peak height of synthetic maps")
+	parser.add_argument("--shape", default="lorentzian", choices=["lorentzian", "gaussian", "pseudo-voigt"],
+			help="peak shape of synthetic maps")
+	parser.add_argument("--empty-fraction", type=float, default=0.1,
+			help="fraction of synthetic pixels without peaks")
+	parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES, help="stages to run")
+	parser.add_argument("--repeat", type=int, default=1, help="runs per stage, the fastest is reported")
+	parser.add_argument("--workers", type=int, default=1, help="processes used for fitting")
+	parser.add_argument("--no-memory", action="store_true", help="skip the (slow) peak memory runs")
+	parser.add_argument("--output", default=None, help="path of the JSON results (default printed only)")
+	parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare with")
+	parser.add_argument("--threshold", type=float, default=0.2,
+			help="relative slowdown reported as a regression (default 0.2)")
+	args = parser.parse_args(argv)
+
+	# memoized fits would make every run after the first one measure lookups instead of fitting
+	fit_memo.enabled = False
+
+	results = []
+	for fpath in args.maps:
+		print(os.path.basename(fpath))
+		results.extend(bench_map(fpath, args.stages, args.repeat, args.workers, not args.no_memory))
+
+	if args.scales:
+		wavenums, x, y, raw = read_labspec(args.maps[0])
+		with tempfile.TemporaryDirectory() as d:
+			for scale in args.scales:
+				fpath = os.path.join(d, f"synthetic_{scale}x.csv")
+				synthetic_map(fpath, wavenums, len(raw) * scale, args.noise, args.amplitude, args.shape,
+						args.empty_fraction)
+				print(os.path.basename(fpath))
+				for r in bench_map(fpath, args.stages, args.repeat, args.workers, not args.no_memory):
+					r["synthetic"] = {"scale": scale, "noise": args.noise, "amplitude": args.amplitude,
+							"shape": args.shape, "empty_fraction": args.empty_fraction}
+					results.append(r)
+
+	report = {"commit": git_commit(),
+			"date": datetime.datetime.now().isoformat(timespec="seconds"),
+			"python": platform.python_version(),
+			"numpy": np.__version__,
+			"platform": platform.platform(),
+			"cpus": os.cpu_count(),
+			"results": results}
+
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=4)
+		print(f"Results saved to {args.output}")
+
+	if args.compare:
+		with open(args.compare, "r") as f:
+			return 1 if compare(results, json.load(f)["results"], args.threshold) else 0
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
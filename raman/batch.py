@@ -0,0 +1,375 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from raman import instrument
+from raman.config import GRAPHENE
+from raman.heatmap import HeatMap
+from raman.labspec import scan_labspec
+from raman.ramanmap import GrapheneRamanMap
+from raman.render import BadSpectraRenderer
+from raman.utils import timestamp
+
+# outputs that can be selected, named after the check boxes of the GUI's data analysis frame
+OUTPUTS = ["peak_ratio_map", "peak_ratio_hist", "avg_spectrum", "peak_loc_map", "peak_loc_hist", "summ_stat"]
+
+# statistics and titles of the heatmaps and histograms belonging to each output
+HEATMAPS = {"peak_ratio_map": [("ratio_2dg", "2D:G Ratio"), ("ratio_dg", "D:G Ratio")],
+		"peak_loc_map": [("peak_loc_d", "D Peak Location"),
+			("peak_loc_g", "G Peak Location"),
+			("peak_loc_2d", "2D Peak Location")]}
+
+HISTOGRAMS = {"peak_ratio_hist": [("ratio_2dg", "2D:G Ratio"), ("ratio_dg", "D:G Ratio")],
+		"peak_loc_hist": [("peak_loc_d", "D Peak Location (cm^-1)"),
+			("peak_loc_g", "G Peak Location (cm^-1)"),
+			("peak_loc_2d", "2D Peak Location (cm^-1)")]}
+
+# rough peak memory use of an in-memory map per intensity value besides the raw and corrected arrays 
+#  (baseline solver and fitting workspace, always float64), in bytes
+WORKSPACE_BYTES_PER_VALUE = 8
+
+def results_dir(fpath, root=None):
+	"""
+	Creates the directory the results of a map are saved to, named after the map file (a timestamp,
+	  and a counter if needed, is appended if it already exists, so maps sharing a name never share
+	  a directory, even when they are processed in parallel)
+
+	Parameters
+	----------
+	fpath: file path to map data
+	root: directory to create the results directory in (default the directory of the map)
+	"""
+
+	save_dir = os.path.join(os.path.dirname(fpath) if root is None else root,
+			f"{os.path.basename(fpath).split('.')[0]}")
+
+	# creating a directory to store results, mkdir fails if another map (or process) took the name
+	#  first, so the next candidate is tried until one is created
+	candidates = [save_dir]
+	while True:
+		for candidate in candidates:
+			try:
+				os.mkdir(candidate)
+				return candidate
+			except FileExistsError:
+				pass
+		stamped = f"{save_dir}_{timestamp()}"
+		candidates = [stamped] + [f"{stamped}_{i}" for i in range(2, 100)]
+
+def growth_characteristics(material="", time_synthesized="", growth_method="", growth_details=""):
+	"""
+	Creates the contents of the growth_characteristics.txt file
+	"""
+
+	return (f"MATERIAL\n----------\n{material}\n\n"
+			f"DATE/TIME SYNTHESIZED\n----------\n{time_synthesized}\n\n"
+			f"GROWTH METHOD\n----------\n{growth_method}\n\n"
+			f"GROWTH DETAILS\n----------\n{growth_details}")
+
+def estimate_memory(fpath, dtype=float):
+	"""
+	Estimates how much memory (in bytes) analysing a map in memory takes, from the number of spectra
+	  and wavenumbers in the file
+
+	Parameters
+	----------
+	fpath: file path to map data
+	dtype: data type of the intensities (see RamanMap)
+	"""
+
+	wavenums, n_spectra = scan_labspec(fpath)
+	return n_spectra * len(wavenums) * (2 * np.dtype(dtype).itemsize + WORKSPACE_BYTES_PER_VALUE)
+
+def analyze_map(fpath,
+		thresh=15,
+		outputs=OUTPUTS,
+		templates=None,
+		root=None,
+		savebad=False,
+		growth=None,
+		out_of_core=False,
+		cache=True,
+		store=True,
+		method="curve_fit",
+		dtype=float):
+	"""
+	Loads, filters and analyses a single map, saving the selected outputs in the same layout as the
+	  GUI (heatmaps are saved straight away, with the template of their statistic if one is given)
+
+	Exceptions are caught and reported in the returned summary, so one broken file does not stop
+	  a batch
+
+	Parameters
+	----------
+	fpath: file path to map data
+	thresh: signal-to-noise threshold below which to exclude spectra (default 15)
+	outputs: list of outputs to create (see OUTPUTS)
+	templates: optional dictionary of heatmap templates (as saved by the image editor) by statistic
+	root: directory to create the results directory in (default the directory of the map)
+	savebad: whether to save images of the rejected spectra (into <map name>_bad_spectra)
+	growth: optional dictionary of growth characteristics (keyword arguments of
+	  growth_characteristics)
+	out_of_core: whether to analyse the map from memory-mapped arrays (see RamanMap)
+	cache: whether to use the binary cache of the map (see RamanMap)
+	store: whether to reuse and save the fit results of the map (see RamanMap)
+	method: peak fitting method, 'curve_fit', 'batch' or 'joint' (see RamanMap.fit_peaks)
+	dtype: data type of the intensities (see RamanMap)
+
+	Returns
+	----------
+	dictionary with the file, status ('ok' or 'failed'), error message, results directory, number of
+	  spectra, number of spectra passing the filter and the time (in seconds) taken by each stage
+	"""
+
+	summary = {"file": fpath,
+			"status": "failed",
+			"error": "",
+			"save_dir": "",
+			"spectra": 0,
+			"present": 0,
+			"out_of_core": out_of_core,
+			"load_s": 0.0,
+			"filter_s": 0.0,
+			"analysis_s": 0.0,
+			"total_s": 0.0}
+	templates = templates or {}
+	start = time.perf_counter()
+	instrument.reset()
+
+	try:
+		t = time.perf_counter()
+		rmap = GrapheneRamanMap(fpath, GRAPHENE, out_of_core=out_of_core, cache=cache, store=store, dtype=dtype)
+		summary["spectra"] = len(rmap)
+		summary["load_s"] = time.perf_counter() - t
+
+		t = time.perf_counter()
+		renderer = None
+		if savebad:
+			bad_dir = os.path.join(os.path.dirname(fpath) if root is None else root,
+					f"{os.path.basename(fpath).split('.')[0]}_bad_spectra")
+			os.makedirs(bad_dir, exist_ok=True)
+			renderer = BadSpectraRenderer(bad_dir, workers=1)
+
+		# batches already run one map per process, so fitting is done serially
+		rmap.data_summary(thresh, renderer, workers=1, method=method)
+		if renderer:
+			renderer.wait()
+		summary["present"] = int(rmap.spectra_characteristics["present"].sum())
+		summary["filter_s"] = time.perf_counter() - t
+
+		t = time.perf_counter()
+		save_dir = results_dir(fpath, root)
+		summary["save_dir"] = save_dir
+
+		with open(os.path.join(save_dir, "growth_characteristics.txt"), "w") as f:
+			f.write(growth_characteristics(**(growth or {})))
+
+		scale_range = {"statistic": [],
+				"scale_bot": [],
+				"scale_top": [],
+				"x-range": [],
+				"y-range": []}
+
+		for output in outputs:
+			for statistic, title in HEATMAPS.get(output, []):
+				heatmap = HeatMap(rmap, statistic, title)
+				if statistic in templates:
+					heatmap.load_template(templates[statistic])
+				heatmap.save(save_dir)
+
+				scale_range["statistic"].append(title)
+				scale_range["scale_bot"].append(heatmap.scale_bot)
+				scale_range["scale_top"].append(heatmap.scale_top)
+				scale_range["x-range"].append(f"{rmap.min_x - rmap.min_x} - {rmap.max_x - rmap.min_x}")
+				scale_range["y-range"].append(f"{rmap.min_y - rmap.min_y} - {rmap.max_y - rmap.min_y}")
+
+			for statistic, unit in HISTOGRAMS.get(output, []):
+				rmap.create_histogram(statistic, unit, os.path.join(save_dir, f"{statistic}_hist.png"))
+
+		if "avg_spectrum" in outputs:
+			rmap.average_spectrum(os.path.join(save_dir, "average_spectrum.png"))
+
+		if "summ_stat" in outputs:
+			rmap.category_statistics(os.path.join(save_dir, "statistics.csv"))
+
+		# save scalebar range information to .csv
+		if len(scale_range["statistic"]) > 0:
+			pd.DataFrame(data=scale_range).to_csv(os.path.join(save_dir, "scalebar_ranges.csv"), index=False)
+
+		if instrument.enabled():
+			instrument.dump(save_dir)
+
+		summary["analysis_s"] = time.perf_counter() - t
+		summary["status"] = "ok"
+	except Exception as e:
+		summary["error"] = f"{type(e).__name__}: {e}"
+
+	summary["total_s"] = time.perf_counter() - start
+	return summary
+
+def run_batch(files, workers=None, memory_budget=None, out_of_core=False, **kwargs):
+	"""
+	Analyses many maps concurrently, one map per worker process, never starting a map while the
+	  estimated memory use of the running ones would exceed the memory budget
+
+	A map whose estimate alone exceeds the budget is analysed out-of-core (from memory-mapped
+	  arrays) so it can still be processed
+
+	Parameters
+	----------
+	files: list of map file paths
+	workers: number of worker processes (default number of CPUs)
+	memory_budget: maximum estimated memory use (in bytes) of the maps analysed at the same time
+	  (default no limit)
+	out_of_core: whether to analyse every map out-of-core
+	kwargs: keyword arguments passed on to analyze_map
+
+	Returns
+	----------
+	list of the summaries returned by analyze_map, in the order of files
+	"""
+
+	workers = workers or os.cpu_count() or 1
+	summaries = [None] * len(files)
+
+	# estimated memory use of each map, maps that are too large on their own are analysed out-of-core
+	#  and only need a fraction of the budget
+	pending = []
+	for n, fpath in enumerate(files):
+		try:
+			cost = estimate_memory(fpath, kwargs.get("dtype", float))
+		except (OSError, ValueError) as e:
+			summaries[n] = {"file": fpath, "status": "failed", "error": f"{type(e).__name__}: {e}"}
+			continue
+		too_large = memory_budget is not None and cost > memory_budget
+		if too_large:
+			cost = memory_budget // 2
+		pending.append((n, fpath, cost, out_of_core or too_large))
+
+	running = {}
+	used = 0
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		while pending or running:
+			# starting maps in order while there are idle workers and room in the budget
+			while pending and len(running) < workers:
+				n, fpath, cost, map_out_of_core = pending[0]
+				if running and memory_budget is not None and used + cost > memory_budget:
+					break
+				pending.pop(0)
+				future = pool.submit(analyze_map, fpath, out_of_core=map_out_of_core, **kwargs)
+				running[future] = (n, cost)
+				used += cost
+
+			finished, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in finished:
+				n, cost = running.pop(future)
+				used -= cost
+				summaries[n] = future.result()
+				print(f"[{sum(s is not None for s in summaries)}/{len(files)}] {summaries[n]['file']}: "
+						f"{summaries[n]['status']} ({summaries[n]['total_s']:.1f} s)")
+
+	return summaries
+
+def parse_size(size):
+	"""
+	Parses a memory size such as 512M, 2G or 1500000000 into a number of bytes
+	"""
+
+	units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+	size = size.strip().upper().rstrip("B")
+	if size and size[-1] in units:
+		return int(float(size[:-1]) * units[size[-1]])
+	return int(size)
+
+def main(argv=None):
+	"""
+	Command-line entry point (python -m raman batch ...)
+	"""
+
+	parser = argparse.ArgumentParser(prog="python -m raman", description="Raman map analysis")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+
+	batch = subparsers.add_parser("batch", help="analyse many maps without the GUI")
+	batch.add_argument("files", nargs="+", help="LabSpec map files (.csv or .txt) or glob patterns")
+	batch.add_argument("--snr", type=float, default=15, help="signal-to-noise threshold (default 15)")
+	batch.add_argument("--outputs", nargs="+", choices=OUTPUTS, default=OUTPUTS,
+			help="outputs to create (default all)")
+	batch.add_argument("--template", action="append", default=[],
+			help="heatmap template .json file, applied to the heatmap of its statistic (repeatable)")
+	batch.add_argument("--output-dir", default=None,
+			help="directory to create the results directories in (default next to each map)")
+	batch.add_argument("--save-bad", action="store_true", help="save images of rejected spectra")
+	batch.add_argument("--workers", type=int, default=None, help="number of processes (default number of CPUs)")
+	batch.add_argument("--memory-budget", type=parse_size, default=None,
+			help="maximum estimated memory of the maps analysed at once, i.e. 4G (default no limit)")
+	batch.add_argument("--out-of-core", action="store_true", help="analyse every map from memory-mapped arrays")
+	batch.add_argument("--no-cache", action="store_true", help="do not read or write binary map caches")
+	batch.add_argument("--no-store", action="store_true", help="do not reuse or save fit results")
+	batch.add_argument("--fit-method", choices=["curve_fit", "batch", "joint"], default="curve_fit",
+			help="peak fitting method, 'joint' fits every band of a spectrum in one optimization (default "
+			"curve_fit)")
+	batch.add_argument("--dtype", choices=["float64", "float32"], default="float64",
+			help="data type of the intensities, float32 halves their memory (default float64)")
+	batch.add_argument("--instrument", choices=["time", "memory"], default=None,
+			help="save per-stage timings and counters (and peak memory) as instrumentation.json/.csv in each "
+			"results directory")
+	batch.add_argument("--summary", default=None,
+			help="path of the timing and status summary .csv (default batch_summary_<timestamp>.csv in "
+			"the output directory, or the current directory)")
+	batch.add_argument("--material", default="", help="material, saved in growth_characteristics.txt")
+	batch.add_argument("--time-synthesized", default="", help="date/time synthesized")
+	batch.add_argument("--growth-method", default="", help="growth method")
+	batch.add_argument("--growth-details", default="", help="growth details")
+
+	args = parser.parse_args(argv)
+
+	if args.instrument:
+		# set in the environment as well, so worker processes that are spawned rather than forked
+		#  pick it up
+		os.environ["RAMAN_INSTRUMENT"] = "memory" if args.instrument == "memory" else "1"
+		instrument.enable(args.instrument == "memory")
+
+	# expanding glob patterns (and keeping plain paths so missing files are reported)
+	files = []
+	for pattern in args.files:
+		matches = sorted(glob.glob(pattern))
+		files.extend(matches if matches else [pattern])
+
+	templates = {}
+	for path in args.template:
+		with open(path, "r") as f:
+			data = json.load(f)
+		templates[data["statistic"]] = data
+
+	if args.output_dir:
+		os.makedirs(args.output_dir, exist_ok=True)
+
+	summaries = run_batch(files,
+			args.workers,
+			args.memory_budget,
+			thresh=args.snr,
+			outputs=args.outputs,
+			templates=templates,
+			root=args.output_dir,
+			savebad=args.save_bad,
+			growth={"material": args.material,
+				"time_synthesized": args.time_synthesized,
+				"growth_method": args.growth_method,
+				"growth_details": args.growth_details},
+			out_of_core=args.out_of_core,
+			cache=not args.no_cache,
+			store=not args.no_store,
+			method=args.fit_method,
+			dtype=np.dtype(args.dtype))
+
+	summary_path = args.summary or os.path.join(args.output_dir or ".", f"batch_summary_{timestamp()}.csv")
+	pd.DataFrame(summaries).to_csv(summary_path, index=False)
+	print(f"Summary saved to {summary_path}")
+
+	return 0 if all(s["status"] == "ok" for s in summaries) else 1
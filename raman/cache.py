@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from raman import instrument
+from raman.labspec import read_labspec, scan_labspec
+from raman.npz import atomic_savez, load_keyed_npz
+from raman.utils import remove_baseline
+
+# bumped whenever the layout of the cache file changes so stale caches are ignored
+CACHE_VERSION = 1
+
+def cache_path(fpath):
+	"""
+	Path of the cache file belonging to a map file (stored next to the map)
+
+	Parameters
+	----------
+	fpath: file path to map data
+	"""
+
+	return f"{fpath}.cache.npz"
+
+def file_hash(fpath, blocksize=1 << 20):
+	"""
+	Calculates the SHA-1 hash of a file's contents
+
+	Parameters
+	----------
+	fpath: path of file to hash
+	blocksize: number of bytes read at a time
+	"""
+
+	h = hashlib.sha1()
+	with open(fpath, "rb") as f:
+		for block in iter(lambda: f.read(blocksize), b""):
+			h.update(block)
+	return h.hexdigest()
+
+def cache_key(fpath, bline_params, content_hash=True, dtype=float):
+	"""
+	Creates the dictionary identifying a parsed and baseline-corrected map
+
+	Parameters
+	----------
+	fpath: file path to map data
+	bline_params: dictionary of baseline parameters (lam, p, niter)
+	content_hash: whether to include the hash of the file contents (expensive on large files)
+	dtype: data type of the intensity arrays
+	"""
+
+	stat = os.stat(fpath)
+	key = {"version": CACHE_VERSION,
+			"path": os.path.abspath(fpath),
+			"size": stat.st_size,
+			"mtime": stat.st_mtime,
+			"bline_params": {k: bline_params[k] for k in sorted(bline_params)},
+			"dtype": np.dtype(dtype).name}
+	if content_hash:
+		key["sha1"] = file_hash(fpath)
+	return key
+
+@instrument.stage()
+def load_cache(fpath, bline_params, dtype=float):
+	"""
+	Loads the cached arrays of a map if a cache exists and still matches the map file
+
+	Parameters
+	----------
+	fpath: file path to map data
+	bline_params: dictionary of baseline parameters (lam, p, niter)
+	dtype: data type of the intensity arrays
+
+	Returns
+	----------
+	dictionary with wavenums, x, y, raw and corrected arrays, or None if there is no valid cache
+	"""
+
+	# checking the cheap parts of the key before hashing the file contents
+	loaded = load_keyed_npz(cache_path(fpath), 
+			cache_key(fpath, bline_params, content_hash=False, dtype=dtype),
+			validate=lambda header: header.get("sha1") == file_hash(fpath))
+	if loaded is None or any(k not in loaded[1] for k in ["wavenums", "x", "y", "raw", "corrected"]):
+		return None
+	return loaded[1]
+
+@instrument.stage()
+def save_cache(fpath, bline_params, wavenums, x, y, raw, corrected):
+	"""
+	Saves the parsed and baseline-corrected arrays of a map next to the map file
+
+	Parameters
+	----------
+	fpath: file path to map data
+	bline_params: dictionary of baseline parameters (lam, p, niter)
+	wavenums: wavenumber axis
+	x: x positions of the spectra
+	y: y positions of the spectra
+	raw: 2-D array of raw intensities (one row per spectrum)
+	corrected: 2-D array of baseline-corrected intensities
+	"""
+
+	atomic_savez(cache_path(fpath), 
+			cache_key(fpath, bline_params, dtype=corrected.dtype), 
+			{"wavenums": wavenums, "x": x, "y": y, "raw": raw, "corrected": corrected})
+
+def mmap_dir(fpath):
+	"""
+	Path of the directory holding the memory-mapped conversion of a map file (stored next to the map)
+
+	Parameters
+	----------
+	fpath: file path to map data
+	"""
+
+	return f"{fpath}.mmap"
+
+@instrument.stage()
+def load_mmap(fpath, bline_params, dtype=float):
+	"""
+	Opens the memory-mapped conversion of a map if it exists and still matches the map file
+
+	Parameters
+	----------
+	fpath: file path to map data
+	bline_params: dictionary of baseline parameters (lam, p, niter)
+	dtype: data type of the on-disk intensity arrays
+
+	Returns
+	----------
+	dictionary with wavenums, x, y, raw and corrected arrays (raw and corrected are read-only
+	  memmaps), or None if there is no valid conversion
+	"""
+
+	path = mmap_dir(fpath)
+	header_path = os.path.join(path, "header.json")
+	if not os.path.exists(header_path):
+		return None
+
+	try:
+		with open(header_path, "r") as f:
+			header = json.load(f)
+
+		key = cache_key(fpath, bline_params, content_hash=False, dtype=dtype)
+		if any(header.get(k) != v for k, v in key.items()):
+			return None
+		if header.get("sha1") != file_hash(fpath):
+			return None
+
+		data = {k: np.load(os.path.join(path, f"{k}.npy")) for k in ["wavenums", "x", "y"]}
+		for k in ["raw", "corrected"]:
+			data[k] = np.load(os.path.join(path, f"{k}.npy"), mmap_mode="r")
+		return data
+	except (OSError, ValueError, KeyError):
+		return None
+
+@instrument.stage()
+def create_mmap(fpath, bline_params, chunk_size=1024, dtype=float, progress=None):
+	"""
+	Converts a map file into memory-mapped .npy arrays on disk (raw intensities are streamed
+	  straight from the text file into the memmap and baselines are removed chunk by chunk, so the
+	  map never has to fit in memory)
+
+	Parameters
+	----------
+	fpath: file path to map data
+	bline_params: dictionary of baseline parameters (lam, p, niter)
+	chunk_size: number of spectra baseline-corrected at a time
+	dtype: data type of the on-disk intensity arrays
+	progress: optional callback, called as progress(stage, done, total) while reading and
+	  baseline-correcting the map
+
+	Returns
+	----------
+	dictionary with wavenums, x, y, raw and corrected arrays (raw and corrected are read-only
+	  memmaps)
+	"""
+
+	path = mmap_dir(fpath)
+	os.makedirs(path, exist_ok=True)
+
+	# removing the header first so an interrupted conversion is never mistaken for a valid one
+	header_path = os.path.join(path, "header.json")
+	if os.path.exists(header_path):
+		os.remove(header_path)
+
+	wavenums, n_spectra = scan_labspec(fpath)
+	shape = (n_spectra, len(wavenums))
+
+	raw = np.lib.format.open_memmap(os.path.join(path, "raw.npy"), mode="w+", dtype=dtype, shape=shape)
+	wavenums, x, y, raw = read_labspec(fpath, out=raw, progress=progress)
+	raw.flush()
+
+	corrected = np.lib.format.open_memmap(os.path.join(path, "corrected.npy"), 
+			mode="w+", 
+			dtype=dtype, 
+			shape=shape)
+	remove_baseline(raw, out=corrected, chunk_size=chunk_size, progress=progress, **bline_params)
+	corrected.flush()
+	del raw, corrected
+
+	np.save(os.path.join(path, "wavenums.npy"), wavenums)
+	np.save(os.path.join(path, "x.npy"), x)
+	np.save(os.path.join(path, "y.npy"), y)
+
+	with open(header_path, "w") as f:
+		json.dump(cache_key(fpath, bline_params, dtype=dtype), f)
+
+	return load_mmap(fpath, bline_params, dtype)
@@ -0,0 +1,248 @@
+import numpy as np
+from scipy.special import wofz
+
+from raman import instrument
+from raman.utils import guess_lorentzian, levenberg_marquardt, lorentzian_jacobian
+
+# constants of the area-normalized Gaussian with half width at half maximum gamma
+LN2 = np.log(2)
+GAUSS_NORM = np.sqrt(LN2 / np.pi)
+
+
+class PeakProfile:
+	def __init__(self, name, params, model, fwhm, height, guess, bounds=None):
+		"""
+		Line shape of a Raman band, holding everything needed to fit it (the first three parameters
+		  of every shape are the amplitude (area), gamma and peak location, like lorentzian)
+
+		Parameters
+		----------
+		name: name of the shape
+		params: names of the parameters
+		model: function of the wavenumbers and an (N, len(params)) array of parameters returning the
+		  bands (N, M) and their Jacobian (N, M, len(params))
+		fwhm: function of an (N, len(params)) array of parameters returning the full width at half
+		  maximum of each band
+		height: function of an (N, len(params)) array of parameters returning the height of each band
+		guess: function turning Lorentzian initial guesses (N, 3) into initial guesses of the shape
+		bounds: optional dictionary of (lower, upper) bounds of the parameters beyond the first three
+		"""
+
+		self.name = name
+		self.params = params
+		self.model = model
+		self.fwhm = fwhm
+		self.height = height
+		self.guess = guess
+		self.bounds = bounds or {}
+
+	@property
+	def n_params(self):
+		return len(self.params)
+
+
+def pseudo_voigt_jacobian(x, P):
+	"""
+	Calculates pseudo-Voigt profiles (a mix of a Lorentzian and a Gaussian sharing the same area,
+	  half width and location, the fraction eta being Lorentzian) and their partial derivatives
+
+	Parameters
+	----------
+	x: x-axis data (wavenumbers)
+	P: array of amplitudes, gammas, peak locations and Lorentzian fractions of shape (N, 4)
+
+	Returns
+	----------
+	array of shape (N, len(x)) holding the profiles and array of shape (N, len(x), 4) holding their
+	  derivatives
+	"""
+
+	amp, gamm, x_0, eta = P[:, 0, None], P[:, 1, None], P[:, 2, None], P[:, 3, None]
+	u = x - x_0
+	den = u**2 + gamm**2
+	lor = gamm / (np.pi * den)
+	gau = GAUSS_NORM / gamm * np.exp(-LN2 * u**2 / gamm**2)
+	shape = eta * lor + (1 - eta) * gau
+
+	d_gamm = eta * (u**2 - gamm**2) / (np.pi * den**2) + (1 - eta) * gau * (2 * LN2 * u**2 / gamm**3 - 1 / gamm)
+	d_x_0 = eta * 2 * gamm * u / (np.pi * den**2) + (1 - eta) * gau * 2 * LN2 * u / gamm**2
+
+	J = np.stack([shape, amp * d_gamm, amp * d_x_0, amp * (lor - gau)], axis=2)
+	return amp * shape, J
+
+def voigt_jacobian(x, P):
+	"""
+	Calculates Voigt profiles (a Lorentzian of half width gamma convolved with a Gaussian of standard
+	  deviation sigma, from the Faddeeva function) and their partial derivatives
+
+	Parameters
+	----------
+	x: x-axis data (wavenumbers)
+	P: array of amplitudes, gammas, peak locations and sigmas of shape (N, 4)
+
+	Returns
+	----------
+	array of shape (N, len(x)) holding the profiles and array of shape (N, len(x), 4) holding their
+	  derivatives
+	"""
+
+	amp, gamm, x_0, sigma = P[:, 0, None], P[:, 1, None], P[:, 2, None], P[:, 3, None]
+	s = sigma * np.sqrt(2)
+	z = (x - x_0 + 1j * gamm) / s
+	w = wofz(z)
+	norm = 1 / (sigma * np.sqrt(2 * np.pi))
+	shape = w.real * norm
+
+	# derivative of the Faddeeva function, w'(z) = -2 z w(z) + 2i / sqrt(pi)
+	dw = -2 * z * w + 2j / np.sqrt(np.pi)
+
+	J = np.stack([shape,
+		amp * norm * (dw * 1j / s).real,
+		amp * norm * (dw * -1 / s).real,
+		amp * (norm * (dw * -z / sigma).real - shape / sigma)], axis=2)
+	return amp * shape, J
+
+def _voigt_fwhm(P):
+	# approximation of Olivero and Longbothum (accurate to 0.02 %)
+	f_l = 2 * np.abs(P[..., 1])
+	f_g = 2 * np.abs(P[..., 3]) * np.sqrt(2 * LN2)
+	return 0.5346 * f_l + np.sqrt(0.2166 * f_l**2 + f_g**2)
+
+LORENTZIAN = PeakProfile("lorentzian",
+		["amp", "gamm", "x_0"],
+		lorentzian_jacobian,
+		fwhm=lambda P: 2 * np.abs(P[..., 1]),
+		height=lambda P: P[..., 0] / (np.pi * P[..., 1]),
+		guess=lambda p0: p0)
+
+PSEUDO_VOIGT = PeakProfile("pseudo-voigt",
+		["amp", "gamm", "x_0", "eta"],
+		pseudo_voigt_jacobian,
+		fwhm=lambda P: 2 * np.abs(P[..., 1]),
+		height=lambda P: P[..., 0] * (P[..., 3] / (np.pi * P[..., 1]) + (1 - P[..., 3]) * GAUSS_NORM / P[..., 1]),
+		guess=lambda p0: np.column_stack([p0, np.full(len(p0), 0.5)]),
+		bounds={"eta": (0, 1)})
+
+VOIGT = PeakProfile("voigt",
+		["amp", "gamm", "x_0", "sigma"],
+		voigt_jacobian,
+		fwhm=_voigt_fwhm,
+		height=lambda P: P[..., 0] * wofz(1j * np.abs(P[..., 1]) / (P[..., 3] * np.sqrt(2))).real / (P[..., 3] * np.sqrt(2 * np.pi)),
+		# half the width is started as Lorentzian and half as Gaussian
+		guess=lambda p0: np.column_stack([p0[:, 0], p0[:, 1] / 2, p0[:, 2], p0[:, 1] / (2 * np.sqrt(2 * LN2))]),
+		bounds={"sigma": (0.1, np.inf)})
+
+PROFILES = {p.name: p for p in [LORENTZIAN, PSEUDO_VOIGT, VOIGT]}
+
+def guess_bands(x, Y, locations, profile=LORENTZIAN):
+	"""
+	Makes data-driven initial guesses of the bands of one peak window for many spectra
+
+	Parameters
+	----------
+	x: x-axis data (wavenumbers) of the window
+	Y: 2-D array of y-axis data (intensity), one spectrum per row
+	locations: approximate location of each band in the window, a single band may have location None
+	  to start it at the maximum of the window
+	profile: PeakProfile of the bands
+
+	Returns
+	----------
+	array of initial guesses of shape (N, len(locations) * profile.n_params)
+	"""
+
+	p0 = guess_lorentzian(x, Y)
+	if len(locations) == 1 and locations[0] is None:
+		return profile.guess(p0)
+
+	# bands sharing a window start at their approximate location, with the height of the data there
+	#  and no wider than half the spacing between them
+	spacing = np.min(np.diff(np.sort(locations))) if len(locations) > 1 else np.ptp(x)
+	gamm = np.minimum(p0[:, 1], spacing / 2)
+	peak = np.max(Y, axis=1)
+
+	guesses = []
+	for loc in locations:
+		height = np.maximum(Y[:, np.argmin(np.abs(x - loc))], 0.01 * np.abs(peak))
+		guesses.append(profile.guess(np.column_stack([height * np.pi * gamm, gamm, np.full(len(Y), loc)])))
+	return np.concatenate(guesses, axis=1)
+
+@instrument.stage()
+def fit_bands_batch(windows, locations, profile=LORENTZIAN, max_iter=None, tol=1e-8, full_output=False):
+	"""
+	Fits every band of a set of peak windows jointly for many spectra simultaneously: each spectrum
+	  is modelled as the sum of all bands over all windows and fitted in a single Levenberg-Marquardt
+	  optimization with an analytic Jacobian, vectorized across spectra
+
+	Parameters
+	----------
+	windows: list of (wavenumbers, intensities) tuples, one per peak window, where intensities is a
+	  2-D array holding the window of every spectrum
+	locations: list holding the approximate band locations of each window (see guess_bands)
+	profile: PeakProfile of the bands
+	max_iter: maximum number of iterations (default 100 per parameter plus 100, like curve_fit)
+	tol: relative change in parameters below which a fit is considered converged
+	full_output: if True the standard errors of the parameters are returned as well
+
+	Returns
+	----------
+	array of best fit parameters of shape (N, number of bands, profile.n_params), boolean mask of
+	  which spectra converged, with no band held at a bound of its width or location (and array of
+	  standard errors of the same shape if full_output)
+	"""
+
+	x = np.concatenate([np.asarray(wx, dtype=float) for wx, wy in windows])
+	Y = np.concatenate([np.asarray(wy, dtype=float) for wx, wy in windows], axis=1)
+	N = len(Y)
+	K = sum(len(l) for l in locations)
+	n = profile.n_params
+
+	# every band is kept inside its window, with a non-negative amplitude and a half width between 
+	#  one wavenumber sample (narrower bands would be spikes fitted to single noisy samples) and the
+	#  width of the window (plus the bounds of the profile's own parameters)
+	extra = [profile.bounds.get(p, (-np.inf, np.inf)) for p in profile.params[3:]]
+	lower, upper = [], []
+	for (wx, wy), l in zip(windows, locations):
+		wx = np.asarray(wx, dtype=float)
+		lower += len(l) * ([0, np.median(np.abs(np.diff(wx))), np.min(wx)] + [b[0] for b in extra])
+		upper += len(l) * ([np.inf, np.ptp(wx), np.max(wx)] + [b[1] for b in extra])
+	bounds = np.array(lower, dtype=float), np.array(upper, dtype=float)
+
+	p0 = np.concatenate([guess_bands(np.asarray(wx, dtype=float), np.asarray(wy, dtype=float), l, profile)
+			for (wx, wy), l in zip(windows, locations)], axis=1)
+
+	def model(P):
+		# every band is evaluated over every window, so the tails of neighbouring bands are included
+		f = np.zeros((len(P), len(x)))
+		J = np.empty((len(P), len(x), K * n))
+		for k in range(K):
+			f_k, J[:, :, k*n:(k+1)*n] = profile.model(x, P[:, k*n:(k+1)*n])
+			f += f_k
+		return f, J
+
+	if max_iter is None:
+		max_iter = 100 * (K * n + 1)
+
+	result = levenberg_marquardt(model, Y, p0, max_iter, tol, 
+			bounds=bounds, 
+			full_output=full_output)
+	params = result[0].reshape(N, K, n)
+
+	# a band held at a bound of its location, as narrow as the bounds allow or as wide as its window
+	#  did not find a band in the data, so the fit is not converged (unless the band is absent, an
+	#  amplitude of zero leaves its shape undetermined), the width is checked on the full width at
+	#  half maximum as i.e. a Gaussian-like Voigt band rightly holds gamma at its lower bound
+	lo, hi = bounds[0].reshape(K, n), bounds[1].reshape(K, n)
+	at_bound = (np.isclose(params[:, :, 2], lo[:, 2], rtol=1e-6, atol=0)
+			| np.isclose(params[:, :, 2], hi[:, 2], rtol=1e-6, atol=0)
+			| np.isclose(params[:, :, 1], hi[:, 1], rtol=1e-6, atol=0)
+			| (profile.fwhm(params) <= profile.fwhm(lo) * (1 + 1e-6)))
+	pinned = np.any(at_bound & (params[:, :, 0] > 0), axis=1)
+	converged = result[1] & ~pinned
+
+	instrument.count("fit_bands_batch", "iterations", result[2])
+	instrument.count("fit_bands_batch", "failures", int(np.sum(~converged)))
+
+	if full_output:
+		return params, converged, result[3].reshape(N, K, n)
+	return params, converged
@@ -0,0 +1,168 @@
+import numpy as np
+
+
+def _collisions(cluster, other):
+	# number of positions that share both their level and their line of the other axis with another
+	key = np.sort(cluster.astype(np.int64) * (int(np.max(other)) + 1) + other)
+	return int(np.sum(key[1:] == key[:-1]))
+
+def _axis_levels(v, tol, other=None):
+	"""
+	Groups jittered stage positions along one axis into grid levels
+
+	Parameters
+	----------
+	v: stage positions along the axis
+	tol: fraction of the largest gap between sorted positions below which positions are considered
+	  to be the same level
+	other: optional grid line of each position along the other axis, positions on the same line of
+	  the other axis are only put on the same level if they are at the same position (so one large
+	  gap, i.e. a skipped region, can not merge neighbouring grid lines)
+
+	Returns
+	----------
+	integer level of each position (gaps left by skipped levels are kept), step between levels,
+	  position of each level
+	"""
+
+	order = np.argsort(v, kind="stable")
+	s = v[order]
+	gaps = np.diff(s)
+
+	if len(gaps) == 0 or np.max(gaps) == 0:
+		return np.zeros(len(v), dtype=int), 1.0, s[:1]
+
+	# a new level starts wherever the gap between consecutive sorted positions is above the threshold
+	def levels_at(thresh):
+		return np.concatenate(([0], np.cumsum(gaps > thresh)))
+
+	thresh = tol * np.max(gaps)
+	if other is not None and np.any(gaps <= thresh):
+		# merging lines only ever adds collisions, so the largest gap that can be treated as jitter 
+		#  without adding any to those of keeping every distinct position apart is found by bisection
+		other = np.asarray(other)[order]
+		allowed = _collisions(levels_at(0), other)
+		candidates = np.unique(gaps[gaps <= thresh])
+		lo, hi = 0, len(candidates) - 1
+		if _collisions(levels_at(candidates[hi]), other) == allowed:
+			lo = hi
+		while lo < hi:
+			mid = (lo + hi + 1) // 2
+			if _collisions(levels_at(candidates[mid]), other) == allowed:
+				lo = mid
+			else:
+				hi = mid - 1
+		thresh = candidates[lo] if _collisions(levels_at(candidates[lo]), other) == allowed else 0
+
+	cluster = levels_at(thresh)
+	centers = np.bincount(cluster, weights=s) / np.bincount(cluster)
+
+	if len(centers) == 1:
+		return np.zeros(len(v), dtype=int), 1.0, centers
+
+	# the median spacing between levels is the step, so missing rows/columns leave holes
+	step = np.median(np.diff(centers))
+	levels = np.empty(len(v), dtype=int)
+	levels[order] = np.rint((centers[cluster] - centers[0]) / step).astype(int)
+	return levels, step, centers
+
+class GridIndex:
+	def __init__(self, x, y, tol=0.25):
+		"""
+		Maps every spectrum of a map to an integer (row, column) position on the map grid, built once
+		  when the map is loaded
+
+		Rows run along y (row 0 at the lowest y) and columns along x (column 0 at the lowest x)
+
+		Parameters
+		----------
+		x: x stage position of each spectrum
+		y: y stage position of each spectrum
+		tol: fraction of the largest gap between sorted positions below which stage positions are
+		  treated as jitter around the same grid line (default 0.25), lowered as far as needed to 
+		  keep spectra of the same row (or column) on separate columns (or rows)
+		"""
+
+		x = np.asarray(x, dtype=float)
+		y = np.asarray(y, dtype=float)
+
+		self.cols, self.x_step, self.x_levels = _axis_levels(x, tol)
+		self.rows, self.y_step, self.y_levels = _axis_levels(y, tol)
+
+		# each axis is levelled again using the lines of the other, until neither changes
+		for i in range(3):
+			cols, x_step, x_levels = _axis_levels(x, tol, self.rows)
+			rows, y_step, y_levels = _axis_levels(y, tol, cols)
+			changed = not (np.array_equal(cols, self.cols) and np.array_equal(rows, self.rows))
+			self.cols, self.x_step, self.x_levels = cols, x_step, x_levels
+			self.rows, self.y_step, self.y_levels = rows, y_step, y_levels
+			if not changed:
+				break
+		self.shape = (int(np.max(self.rows)) + 1, int(np.max(self.cols)) + 1)
+
+		self.scan_order, self.serpentine = self._detect_scan_order()
+
+	def __len__(self):
+		return len(self.rows)
+
+	def _detect_scan_order(self):
+		"""
+		Works out the order in which the spectra were acquired: 'row-major' if consecutive spectra
+		  mostly share a row (x changes fastest), otherwise 'column-major', and whether every other
+		  line was scanned in reverse (a serpentine or snake scan)
+		"""
+
+		if len(self) < 2:
+			return "row-major", False
+
+		same_row = np.mean(np.diff(self.rows) == 0)
+		same_col = np.mean(np.diff(self.cols) == 0)
+		if same_row >= same_col:
+			scan_order, line, pos = "row-major", self.rows, self.cols
+		else:
+			scan_order, line, pos = "column-major", self.cols, self.rows
+
+		# direction of travel along each line, a serpentine scan alternates between lines
+		steps = np.diff(pos)
+		along = np.diff(line) == 0
+		directions = [np.sign(np.sum(steps[along & (line[:-1] == i)])) for i in np.unique(line)]
+		directions = [d for d in directions if d != 0]
+		serpentine = len(directions) > 1 and all(a != b for a, b in zip(directions, directions[1:]))
+		return scan_order, serpentine
+
+	def dense(self, values, fill=np.nan):
+		"""
+		Arranges a per-spectrum statistic on the map grid
+
+		Parameters
+		----------
+		values: array holding one value per spectrum
+		fill: value of grid positions without a spectrum (default NaN)
+
+		Returns
+		----------
+		array of shape (rows, columns) with row 0 at the lowest y
+		"""
+
+		values = np.asarray(values)
+		grid = np.full(self.shape + values.shape[1:], fill, dtype=np.result_type(values, fill))
+		grid[self.rows, self.cols] = values
+		return grid
+
+	def raster_order(self, indices=None):
+		"""
+		Orders spectra in a serpentine raster (every other row reversed) so consecutive spectra are
+		  always grid neighbours
+
+		Parameters
+		----------
+		indices: optional indices of the spectra to order (default all spectra)
+
+		Returns
+		----------
+		positions into indices (or into the spectra) in raster order
+		"""
+
+		indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+		rows, cols = self.rows[indices], self.cols[indices]
+		return np.lexsort((np.where(rows % 2, -cols, cols), rows))
@@ -2,15 +2,18 @@ import json
 import os
 import tkinter as tk
 from tkinter import filedialog as fd
+from tkinter import ttk
 
 import pandas as pd
 from PIL import Image, ImageTk
 
+from raman import instrument
+from raman.batch import growth_characteristics, results_dir
 import raman.config
 from raman.heatmap import HeatMap
 import raman.material
 from raman.ramanmap import GrapheneRamanMap
-from raman.utils import timestamp
+from raman.worker import Job
 
 
 def auto_update_entry(entry, value):
@@ -56,8 +59,14 @@ class App(tk.Frame):
 		self.locd_heatmap_image = None
 		self.locg_heatmap_image = None
 		self.loc2d_heatmap_image = None
+		self.preview_image = None
 
 		self.save_dir = None
+
+		# background job currently running (loading, filtering or analysis), polled with after()
+		self.job = None
+		self._job_status = ""
+		self._job_done = None
 	
 	def _build_frames(self):
 		"""
@@ -112,6 +121,22 @@ class App(tk.Frame):
 		# TODO: allow for selection of defined materials
 		self.mat_selection_menu = tk.OptionMenu(self.file_input_frame, self.mat_selection_var, *["Graphene", "MoS2"])
 		self.mat_selection_menu.grid(column=4, row=3, columnspan=2, sticky="ew")
+
+		# Progress bar of background jobs
+		self.progress_var = tk.DoubleVar(self.file_input_frame, value=0)
+		self.progress_bar = ttk.Progressbar(self.file_input_frame, variable=self.progress_var, maximum=1.0)
+		self.progress_bar.grid(column=0, row=4, columnspan=4, sticky="ew")
+
+		# Cancel button of background jobs
+		self.cancel_button = tk.Button(self.file_input_frame, 
+				text="Cancel", 
+				command=self._cancel_job, 
+				state=tk.DISABLED)
+		self.cancel_button.grid(column=4, row=4, columnspan=2, sticky="ew")
+
+		# Preview heatmap of the raw intensities of the loaded map
+		self.preview_label = tk.Label(self.file_input_frame)
+		self.preview_label.grid(column=0, row=5, columnspan=6)
 	
 	def _place_filter_frame(self):
 		"""
@@ -245,17 +270,39 @@ class App(tk.Frame):
 		 map data
 		"""
 
-		try:
-			self.selected_file = fd.askopenfilename(defaultextension=".csv", 
-					filetypes=[("All files", "*.*"), ("CSV files", "*.csv"), ("TXT files", "*.txt")])
-			self.source_file_name["text"] = self.selected_file
-			self.status_label["text"] = "Loading map..."
-			self.current_map = GrapheneRamanMap(self.selected_file, raman.config.GRAPHENE)
-			self.status_label["text"] = "Map loaded"
+		selected_file = fd.askopenfilename(defaultextension=".csv", 
+				filetypes=[("All files", "*.*"), ("CSV files", "*.csv"), ("TXT files", "*.txt")])
+		if not selected_file:
+			return
+
+		self.selected_file = selected_file
+		self.source_file_name["text"] = self.selected_file
+		self.current_map = None
+		self.preview_image = None
+		self.preview_label["image"] = ""
+
+		# instrumentation results are collected per map
+		instrument.reset()
+
+		def done(rmap):
+			self.current_map = rmap
+			rows, cols = rmap.grid.shape
+			self.status_label["text"] = (f"Map loaded: {len(rmap)} spectra on a {cols} x {rows} grid, "
+					f"{len(rmap.wavenums)} wavenumbers")
 			self.status_label["background"] = "green"
-		except FileNotFoundError:
-			self.status_label["text"] = "Map not found!"
-			self.status_label["background"] = "red"
+
+			# the mean raw intensity of each pixel is shown straight away, baselines are only removed
+			#  once the map is filtered
+			self.preview_image = ImageTk.PhotoImage(rmap.create_heatmap("raw_intensity", 
+					None, 
+					200, 
+					end_color="white", 
+					gradient=50))
+			self.preview_label["image"] = self.preview_image
+
+		self._start_job(Job(GrapheneRamanMap, self.selected_file, raman.config.GRAPHENE, lazy=True), 
+				"Loading map", 
+				done)
 
 	def _filter_spectra(self):
 		"""
@@ -263,97 +310,259 @@ class App(tk.Frame):
 		 saves bad spectra if requested
 		"""
 		if self.current_map:
-			self.status_label["text"] = "Filtering data..."
-			self.status_label["background"] = None
 			if self.snr_checkbox_var.get():
 				save_path = os.path.join(os.path.dirname(self.selected_file),
 						f"{os.path.basename(self.selected_file).split('.')[0]}_bad_spectra")
-				os.mkdir(save_path)
+				os.makedirs(save_path, exist_ok=True)
 			else:
 				save_path = None
-			self.current_map.data_summary(int(self.snr_entry.get()), save_path)
-			self.status_label["text"] = "Data filtered"
-			self.status_label["background"] = "green"
+
+			def done(result):
+				renderer = self.current_map.bad_spectra if save_path else None
+				saving = renderer is not None and len(renderer.futures) > 0
+				self.status_label["text"] = "Data filtered" + (" (saving bad spectra in background)" if saving else "")
+				self.status_label["background"] = "green"
+				if saving:
+					self.after(500, self._poll_bad_spectra, renderer)
+
+			self._start_job(Job(self.current_map.data_summary, int(self.snr_entry.get()), save_path), 
+					"Filtering data", 
+					done)
 
 		else:
 			self.status_label["text"] = "Please select a map before filtering"
 			self.status_label["background"] = "red"
 		
+	def _poll_bad_spectra(self, renderer):
+		"""
+		Waits (with after(), so the GUI stays responsive) for the bad spectra images to be rendered,
+		  then reports whether saving them succeeded
+		"""
+
+		# images queued by several filters are reported by the first poll that finds them done
+		if not renderer.futures:
+			return
+
+		# the status of a running job is not overwritten
+		if not renderer.done() or self.job:
+			self.after(500, self._poll_bad_spectra, renderer)
+			return
+
+		try:
+			paths = renderer.wait()
+		except Exception as e:
+			self.status_label["text"] = f"Saving bad spectra failed: {e}"
+			self.status_label["background"] = "red"
+		else:
+			self.status_label["text"] = f"Saved {len(paths)} bad spectra images"
+			self.status_label["background"] = "green"
+
 	def _run_analysis(self):
 		"""
-		Run analysis button handler function, runs selected analysis methods
+		Run analysis button handler function, runs selected analysis methods (in the background, the
+		  image editing window is created once they are done)
 		"""
 
 		if self.current_map:
-			self.save_dir = os.path.join(os.path.dirname(self.selected_file),
-					f"{os.path.basename(self.selected_file).split('.')[0]}")
-
 			# creating a directory to store results
-			if os.path.exists(self.save_dir):
-				self.save_dir = f"{self.save_dir}_{timestamp()}"
-
-			os.mkdir(self.save_dir)
+			self.save_dir = results_dir(self.selected_file)
 			
 			# string containing growth characteristics data
-			growth_char_string = (f"MATERIAL\n----------\n{self.mat_desig_entry.get()}\n\n"
-					f"DATE/TIME SYNTHESIZED\n----------\n{self.time_synth_entry.get()}\n\n"
-					f"GROWTH METHOD\n----------\n{self.growth_method_entry.get()}\n\n"
-					f"GROWTH DETAILS\n----------\n{self.growth_details_tb.get('1.0', 'end-1c')}")
-
-			# ...saving growth characteristics
-			with open(os.path.join(self.save_dir, "growth_characteristics.txt"), "w") as f:
-				f.write(growth_char_string)
-
-			# creating heatmaps of peak ratios if requested
-			if self.peak_ratio_map_var.get():
-				self.image_editing_window = True
-				self.ratio2dg_heatmap_image = self.current_map.create_heatmap("ratio_2dg", None, None)
-				self.ratiodg_heatmap_image = self.current_map.create_heatmap("ratio_dg", None, None)
-
-			# creating histograms of peak ratios if requested
-			if self.peak_ratio_hist_var.get():
-				self.current_map.create_histogram("ratio_2dg", 
-						"2D:G Ratio",
-						os.path.join(self.save_dir, "ratio_2dg_hist.png"))
-				self.current_map.create_histogram("ratio_dg",
-						"D:G Ratio",
-						os.path.join(self.save_dir, "ratio_dg_hist.png"))
-
-			# creating average spectrum if requested
-			if self.avg_spectrum_var.get():
-				self.current_map.average_spectrum(os.path.join(self.save_dir, "average_spectrum.png"))
-
-			# creating peak location heatmap if requested
-			if self.peak_loc_map_var.get():
-				self.image_editing_window = True
-				self.locd_heatmap_image = self.current_map.create_heatmap("peak_loc_d", None, None)
-				self.locg_heatmap_image = self.current_map.create_heatmap("peak_loc_g", None, None)
-				self.loc2d_heatmap_image = self.current_map.create_heatmap("peak_loc_2d", None, None)
-
-			# creating peak location histogram if requested
-			if self.peak_loc_hist_var.get():
-				self.current_map.create_histogram("peak_loc_d",
-						"D Peak Location (cm^-1)",
-						os.path.join(self.save_dir, "peak_loc_d_hist.png"))
-				self.current_map.create_histogram("peak_loc_g",
-						"G Peak Location (cm^-1)",
-						os.path.join(self.save_dir, "peak_loc_g_hist.png"))
-				self.current_map.create_histogram("peak_loc_2d",
-						"2D Peak Location (cm^-1)",
-						os.path.join(self.save_dir, "peak_loc_2d_hist.png"))
-
-			# creating summary statistics file if requested
-			if self.summ_stat_var.get():
-				self.current_map.category_statistics(os.path.join(self.save_dir, "statistics.csv"))
-
-			# if any heatmaps were requested...
-			if self.image_editing_window:	
-				# ...create the image editing window
-				self._image_editor()
-				
-				self.img_save_button = tk.Button(self, text="Save Images", command=self._save_imgs)
-				self.img_save_button.grid(column=0, row=20, columnspan=6)
-				self.img_save_button.grid_columnconfigure(0, weight=1)
+			growth_char_string = growth_characteristics(self.mat_desig_entry.get(),
+					self.time_synth_entry.get(),
+					self.growth_method_entry.get(),
+					self.growth_details_tb.get('1.0', 'end-1c'))
+
+			# the selections are read here, widgets must not be touched from the background thread
+			options = {"peak_ratio_map": self.peak_ratio_map_var.get(),
+					"peak_ratio_hist": self.peak_ratio_hist_var.get(),
+					"avg_spectrum": self.avg_spectrum_var.get(),
+					"peak_loc_map": self.peak_loc_map_var.get(),
+					"peak_loc_hist": self.peak_loc_hist_var.get(),
+					"summ_stat": self.summ_stat_var.get()}
+
+			def done(result):
+				self.status_label["text"] = "Analysis complete"
+				self.status_label["background"] = "green"
+
+				# if any heatmaps were requested...
+				if self.image_editing_window:	
+					# ...create the image editing window
+					self._image_editor()
+					
+					self.img_save_button = tk.Button(self, text="Save Images", command=self._save_imgs)
+					self.img_save_button.grid(column=0, row=20, columnspan=6)
+					self.img_save_button.grid_columnconfigure(0, weight=1)
+
+			self._start_job(Job(self._analysis, self.save_dir, growth_char_string, options), 
+					"Running analysis", 
+					done)
+
+	def _analysis(self, save_dir, growth_char_string, options, progress):
+		"""
+		Runs the selected analysis methods and saves their results (runs on a background thread, so
+		  it only touches the map and the file system)
+
+		Parameters
+		----------
+		save_dir: directory to save the results to
+		growth_char_string: growth characteristics text
+		options: dictionary of which analysis methods were selected
+		progress: progress callback of the background job
+		"""
+
+		rmap = self.current_map
+		steps = (1 + 2 * options["peak_ratio_map"] + 2 * options["peak_ratio_hist"] + options["avg_spectrum"] 
+				+ 3 * options["peak_loc_map"] + 3 * options["peak_loc_hist"] + options["summ_stat"])
+		done = 0
+
+		def step(stage):
+			nonlocal done
+			done += 1
+			progress(stage, done, steps, "outputs")
+
+		# ...saving growth characteristics
+		with open(os.path.join(save_dir, "growth_characteristics.txt"), "w") as f:
+			f.write(growth_char_string)
+		step("Saving growth characteristics")
+
+		# creating heatmaps of peak ratios if requested
+		if options["peak_ratio_map"]:
+			self.image_editing_window = True
+			self.ratio2dg_heatmap_image = rmap.create_heatmap("ratio_2dg", None, None)
+			step("Creating heatmaps")
+			self.ratiodg_heatmap_image = rmap.create_heatmap("ratio_dg", None, None)
+			step("Creating heatmaps")
+
+		# creating histograms of peak ratios if requested
+		if options["peak_ratio_hist"]:
+			rmap.create_histogram("ratio_2dg", 
+					"2D:G Ratio",
+					os.path.join(save_dir, "ratio_2dg_hist.png"))
+			step("Creating histograms")
+			rmap.create_histogram("ratio_dg",
+					"D:G Ratio",
+					os.path.join(save_dir, "ratio_dg_hist.png"))
+			step("Creating histograms")
+
+		# creating average spectrum if requested
+		if options["avg_spectrum"]:
+			rmap.average_spectrum(os.path.join(save_dir, "average_spectrum.png"))
+			step("Creating average spectrum")
+
+		# creating peak location heatmap if requested
+		if options["peak_loc_map"]:
+			self.image_editing_window = True
+			self.locd_heatmap_image = rmap.create_heatmap("peak_loc_d", None, None)
+			step("Creating heatmaps")
+			self.locg_heatmap_image = rmap.create_heatmap("peak_loc_g", None, None)
+			step("Creating heatmaps")
+			self.loc2d_heatmap_image = rmap.create_heatmap("peak_loc_2d", None, None)
+			step("Creating heatmaps")
+
+		# creating peak location histogram if requested
+		if options["peak_loc_hist"]:
+			rmap.create_histogram("peak_loc_d",
+					"D Peak Location (cm^-1)",
+					os.path.join(save_dir, "peak_loc_d_hist.png"))
+			step("Creating histograms")
+			rmap.create_histogram("peak_loc_g",
+					"G Peak Location (cm^-1)",
+					os.path.join(save_dir, "peak_loc_g_hist.png"))
+			step("Creating histograms")
+			rmap.create_histogram("peak_loc_2d",
+					"2D Peak Location (cm^-1)",
+					os.path.join(save_dir, "peak_loc_2d_hist.png"))
+			step("Creating histograms")
+
+		# creating summary statistics file if requested
+		if options["summ_stat"]:
+			rmap.category_statistics(os.path.join(save_dir, "statistics.csv"))
+			step("Saving summary statistics")
+
+		# saving the timings and counters of everything done since the map was loaded
+		if instrument.enabled():
+			instrument.dump(save_dir)
+
+	def _start_job(self, job, status, on_done):
+		"""
+		Starts a background job, disabling the buttons that would start another one until it finishes
+
+		Parameters
+		----------
+		job: Job to start
+		status: status text shown while the job runs
+		on_done: function called with the result of the job once it finished successfully
+		"""
+
+		self.job = job
+		self._job_status = status
+		self._job_done = on_done
+
+		self.status_label["text"] = f"{status}..."
+		self.status_label["background"] = None
+		self.progress_var.set(0)
+		for button in [self.open_file_button, self.snr_button, self.run_button]:
+			button["state"] = tk.DISABLED
+		self.cancel_button["state"] = tk.NORMAL
+
+		job.start()
+		self.after(100, self._poll_job)
+
+	def _poll_job(self):
+		"""
+		Reads the messages of the running background job, updating the progress bar and status
+		"""
+
+		for message in self.job.poll():
+			if message[0] == "progress":
+				stage, done, total, unit, rate, eta = message[1:]
+				self.progress_var.set(done / total if total else 1.0)
+				text = f"{stage}: {done}/{total} {unit}"
+				if rate:
+					text += f" ({rate:.0f} {unit}/s, {eta:.0f} s left)"
+				self.status_label["text"] = text
+			else:
+				self._finish_job(message)
+				return
+
+		self.after(100, self._poll_job)
+
+	def _finish_job(self, message):
+		"""
+		Re-enables the buttons once the background job finished, was cancelled or failed
+		"""
+
+		for button in [self.open_file_button, self.snr_button, self.run_button]:
+			button["state"] = tk.NORMAL
+		self.cancel_button["state"] = tk.DISABLED
+		self.job = None
+
+		if message[0] == "done":
+			self.progress_var.set(1.0)
+			self._job_done(message[1])
+			if instrument.enabled():
+				self.status_label["text"] += f" ({instrument.summary()})"
+		elif message[0] == "cancelled":
+			self.progress_var.set(0)
+			self.status_label["text"] = f"{self._job_status} cancelled"
+			self.status_label["background"] = "yellow"
+		else:
+			self.progress_var.set(0)
+			if isinstance(message[1], FileNotFoundError):
+				self.status_label["text"] = "Map not found!"
+			else:
+				self.status_label["text"] = f"{self._job_status} failed: {message[1]}"
+			self.status_label["background"] = "red"
+
+	def _cancel_job(self):
+		"""
+		Cancel button handler function, stops the running background job
+		"""
+
+		if self.job:
+			self.job.cancel()
+			self.status_label["text"] = f"Cancelling {self._job_status.lower()}..."
 
 	def _image_editor(self):
 		"""
@@ -492,13 +701,16 @@ class ImageEditor(tk.LabelFrame):
 		self.title_label = tk.Label(self, text=f"{self.heatmap.title} heatmap", font=("arial", 16, "bold"))
 		self.title_label.grid(column=0, row=0, columnspan=6)
 
-		# Creating and placing the image
-		self.img_tk = ImageTk.PhotoImage(self.heatmap.img.resize((200,200)))
+		# Creating and placing the image (the labels are reused by every update, the images they show
+		#  are only replaced when the heatmap or scalebar actually changed)
+		self._preview_src = self.heatmap.resized((200,200), self.interp_val_decode["BICUBIC"])
+		self.img_tk = ImageTk.PhotoImage(self._preview_src)
 		self.img_label = tk.Label(self, image=self.img_tk)
 		self.img_label.image = self.img_tk
 		self.img_label.grid(column=0, row=1)
 
 		# Scalebar
+		self._sb_src = self.heatmap.scalebar
 		self.sb_tk = ImageTk.PhotoImage(self.heatmap.scalebar.resize((20, 100), Image.NEAREST))
 		self.sb_label = tk.Label(self, image=self.sb_tk)
 		self.sb_label.image = self.sb_tk
@@ -583,17 +795,19 @@ class ImageEditor(tk.LabelFrame):
 		self.heatmap.save_width = int(self.pic_width_entry.get())
 		self.heatmap.calc_img()
 
-		
-		self.img_tk = ImageTk.PhotoImage(self.heatmap.img.resize((200,200), 
-				self.interp_val_decode.get(self.interp_method_var.get())))
-		self.img_label = tk.Label(self, image=self.img_tk)
-		self.img_label.image = self.img_tk
-		self.img_label.grid(column=0, row=1)
+		# resized previews are cached by the heatmap, so an unchanged heatmap gives the same image
+		preview = self.heatmap.resized((200,200), self.interp_val_decode.get(self.interp_method_var.get()))
+		if preview is not self._preview_src:
+			self._preview_src = preview
+			self.img_tk = ImageTk.PhotoImage(preview)
+			self.img_label.configure(image=self.img_tk)
+			self.img_label.image = self.img_tk
 
-		self.sb_tk = ImageTk.PhotoImage(self.heatmap.scalebar.resize((20, 100), Image.NEAREST))
-		self.sb_label = tk.Label(self, image=self.sb_tk)
-		self.sb_label.image = self.sb_tk
-		self.sb_label.grid(column=1, row=1)
+		if self.heatmap.scalebar is not self._sb_src:
+			self._sb_src = self.heatmap.scalebar
+			self.sb_tk = ImageTk.PhotoImage(self.heatmap.scalebar.resize((20, 100), Image.NEAREST))
+			self.sb_label.configure(image=self.sb_tk)
+			self.sb_label.image = self.sb_tk
 
 	def _save_templ(self):
 		"""
@@ -642,14 +856,7 @@ class ImageEditor(tk.LabelFrame):
 		Save images button handler, saves heatmap and scalebar images
 		"""
 
-		# width and height for resizing
-		w = int(self.pic_width_entry.get())
-		h = int(w * self.heatmap.rmap.aspect_ratio)
-
-		sb_thickness = int(h / self.heatmap.scalebar_thickness_ratio)
-		method = self.interp_val_decode.get(self.interp_method_var.get())
-		self.heatmap.img.resize((w,h), method).save(os.path.join(self.master.save_dir, 
-			f"{self.heatmap.statistic}.png"))
-		self.heatmap.scalebar.resize((sb_thickness, h)).save(os.path.join(self.master.save_dir, 
-			f"{self.heatmap.statistic}_scalebar.png"))
+		self.heatmap.save(self.master.save_dir, 
+				int(self.pic_width_entry.get()), 
+				self.interp_val_decode.get(self.interp_method_var.get()))
 
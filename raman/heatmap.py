@@ -1,8 +1,95 @@
+import os
+
 from colour import Color
 from PIL import Image
 import numpy as np
 
-from raman.utils import find_index
+from raman import instrument
+
+
+def color_lut(start_color, end_color, gradient):
+	"""
+	Creates a color lookup table running from the start color to the end color
+
+	Parameters
+	----------
+	start_color: color at beginning of color range
+	end_color: color at end of color range
+	gradient: number of colors in the table
+
+	Returns
+	----------
+	uint8 array of shape (gradient, 3) holding the RGB value of each color
+	"""
+
+	cols = Color(start_color).range_to(Color(end_color), gradient)
+	return np.array([[int(i * 255) for i in c.get_rgb()] for c in cols], dtype=np.uint8).reshape(-1, 3)
+
+def color_bins(values, scale_bot, delta, n_colors):
+	"""
+	Finds the index of the color of each value on a scale (vectorized version of utils.find_index)
+
+	Parameters
+	----------
+	values: array of values
+	scale_bot: value at the bottom of the scale
+	delta: value by which the scale increments per color
+	n_colors: number of colors on the scale
+
+	Returns
+	----------
+	integer array of color indices
+	"""
+
+	with np.errstate(divide="ignore", invalid="ignore"):
+		bins = np.trunc((np.asarray(values, dtype=float) - scale_bot) / delta)
+	bins = np.nan_to_num(bins, nan=0, posinf=n_colors, neginf=0) - 1
+	return np.clip(bins, 0, n_colors - 1).astype(int)
+
+def render_heatmap(rows, cols, shape, bins, lut, incl=None, filtered_rgb=(0, 0, 0)):
+	"""
+	Paints the pixels of a heatmap from their color indices in one vectorized pass
+
+	Parameters
+	----------
+	rows: row (y grid position, counted from the bottom) of each pixel
+	cols: column (x grid position) of each pixel
+	shape: (number of rows, number of columns) of the image
+	bins: color index of each pixel (see color_bins)
+	lut: color lookup table (see color_lut)
+	incl: optional boolean mask of which pixels passed filtering, the others are painted with
+	  filtered_rgb
+	filtered_rgb: RGB color of filtered pixels
+
+	Returns
+	----------
+	uint8 image array of shape (rows, columns, 3)
+	"""
+
+	image_array = np.zeros((shape[0], shape[1], 3), dtype=np.uint8)
+	pix_colors = lut[bins]
+	if incl is not None:
+		pix_colors[~np.asarray(incl, dtype=bool)] = filtered_rgb
+
+	# images are indexed from the top, grid rows from the bottom
+	image_array[shape[0] - np.asarray(rows) - 1, cols] = pix_colors
+	return image_array
+
+def render_scalebar(lut, thickness):
+	"""
+	Paints a vertical scalebar with the lowest color at the bottom
+
+	Parameters
+	----------
+	lut: color lookup table (see color_lut)
+	thickness: width of the scalebar in pixels
+
+	Returns
+	----------
+	uint8 image array of shape (number of colors, thickness, 3)
+	"""
+
+	return np.repeat(lut[::-1, None, :], thickness, axis=1)
 
 
 class HeatMap:
@@ -56,25 +143,32 @@ class HeatMap:
 		self.scalebar_thickness_ratio = 5
 		self.scalebar_thickness = self.gradient // self.scalebar_thickness_ratio
 
-		# extracting spectra data
-		self._xs = [d["x"] for d in self.rmap.spectra_characteristics]
-		self._ys = [d["y"] for d in self.rmap.spectra_characteristics]
-		self._incl = [d["present"] for d in self.rmap.spectra_characteristics]
-		self._scale_x = [int(round((i-self.rmap.min_x) / self.rmap.x_step, 0)) for i in self._xs]
-		self._scale_y = [int(round((i-self.rmap.min_y) / self.rmap.y_step, 0)) for i in self._ys]
-		self._ds = [d[self.statistic] for d in self.rmap.spectra_characteristics]
+		# extracting spectra data (copied, so filtering the map again does not change a heatmap whose
+		#  cached color indices and auto scale were calculated from the old values)
+		sc = self.rmap.spectra_characteristics
+		self._xs = sc["x"].copy()
+		self._ys = sc["y"].copy()
+		self._incl = sc["present"].copy()
+		self._scale_x = self.rmap.grid.cols
+		self._scale_y = self.rmap.grid.rows
+		self._ds = sc[self.statistic].copy()
 
 		if self.scale == "auto":
-			self.scale_bot = np.min([self._ds[i] for i in range(len(self._ds)) if self._incl[i]])
-			self.scale_top = np.max([self._ds[i] for i in range(len(self._ds)) if self._incl[i]])
+			self.scale_bot = np.min(self._ds[self._incl])
+			self.scale_top = np.max(self._ds[self._incl])
 		elif isinstance(self.scale, tuple):
 			self.scale_bot = self.scale[0]
 			self.scale_top = self.scale[1]
 		else:
 			raise ValueError("Invalid type, 'scale' must be tuple")
 
-		# creating the image array as a matrix of zeroes
-		self.image_array = np.zeros([self.rmap.unique_y, self.rmap.unique_x], dtype=(float, 3))
+		# cached color indices, color table and resized images, each is only recalculated when the
+		#  settings it depends on change (see calc_img and resized)
+		self._bins_key = None
+		self._bins = None
+		self._lut_key = None
+		self._lut = None
+		self._resized = {}
 
 		# calculating the image
 		self.calc_img()
@@ -138,33 +232,105 @@ class HeatMap:
 			print(e)
 			return self._end_color
 
+	@instrument.stage()
 	def calc_img(self):	
 		"""
 		Method for calculating appropriate color and position for each pixel, modifies
 		  self.image_array to create final image
+
+		Only the parts affected by changed settings are recalculated: the color index of each pixel
+		  when the scale range or gradient changes, the color table when the colors or gradient 
+		  change, and nothing at all when neither did
+		"""
+
+		bins_key = (self.scale_bot, self.scale_top, self.gradient)
+		lut_key = (self.start_color, self.end_color, self.gradient, self.filtered_col)
+
+		if bins_key == self._bins_key and lut_key == self._lut_key and self.img is not None:
+			return
+
+		# building the color scale once, then coloring every pixel from it at once
+		if lut_key != self._lut_key:
+			self._lut = color_lut(self.start_color, self.end_color, self.gradient)
+			self._lut_key = lut_key
+			self._create_scalebar(self._lut)
+
+		if bins_key != self._bins_key:
+			self._bins = color_bins(self._ds, self.scale_bot, self.delta, len(self._lut))
+			self._bins_key = bins_key
+
+		filtered_rgb = [int(i * 255) for i in Color(self.filtered_col).get_rgb()]
+
+		self.image_array = render_heatmap(self._scale_y, 
+				self._scale_x, 
+				self.rmap.grid.shape,
+				self._bins, 
+				self._lut, 
+				self._incl, 
+				filtered_rgb)
+
+		self.img = Image.fromarray(self.image_array, "RGB")
+		self._resized = {}
+
+	@instrument.stage()
+	def resized(self, size, method=None):
+		"""
+		Returns the heatmap image resized, reusing the previous result if neither the image nor the
+		  requested size and interpolation method have changed
+
+		Parameters
+		----------
+		size: (width, height) tuple of the resized image
+		method: PIL method used to interpolate when resizing (default resize_method)
+		"""
+
+		method = self.resize_method if method is None else method
+		key = (tuple(size), method)
+		if key not in self._resized:
+			self._resized[key] = self.img.resize(key[0], method)
+		return self._resized[key]
+
+	def load_template(self, data):
 		"""
+		Applies the settings of a heatmap template (the .json files saved by the image editor) and
+		  recalculates the image
 
-		# iterating through all points
-		for n, (x,y,d) in enumerate(zip(self._scale_x, self._scale_y, self._ds)):
-			# if the point passes the signal-to-noise ratio test, get the appropriate color
-			if self._incl[n]:
-				pix_color = self.col_array[find_index(d, 
-					self.scale_bot, 
-					self.delta, 
-					len(self.col_array)-1)].get_rgb()
-			
-			# otherwise color it with the filtered_col color
-			else:
-				pix_color = Color(self.filtered_col).get_rgb()
+		Parameters
+		----------
+		data: dictionary loaded from a template file (min_val, max_val, gradient, start_col, end_col,
+		  save_width and optionally resize_method)
+		"""
+
+		self.scale_bot = float(data["min_val"])
+		self.scale_top = float(data["max_val"])
+		self.gradient = int(data["gradient"])
+		self.start_color = data["start_col"]
+		self.end_color = data["end_col"]
+		self.save_width = int(data["save_width"])
+		if "resize_method" in data:
+			self.resize_method = data["resize_method"]
+		self.calc_img()
 
-			# calculating the integer values from the RGB
-			pix_color_int = list(map(lambda x: int(x * 255), pix_color))
-			self.image_array[self.rmap.unique_y - y - 1][x] = pix_color_int
+	@instrument.stage()
+	def save(self, save_dir, width=None, method=None):
+		"""
+		Saves the heatmap (<statistic>.png) and its scalebar (<statistic>_scalebar.png)
+
+		Parameters
+		----------
+		save_dir: directory to save the images to
+		width: width (in pixels) of the heatmap image, height is calculated so that aspect ratio is
+		  maintained (default save_width)
+		method: PIL method used to interpolate when resizing (default resize_method)
+		"""
 
-		self.img = Image.fromarray(np.uint8(self.image_array), "RGB")
+		# width and height for resizing
+		w = self.save_width if width is None else width
+		h = int(w * self.rmap.aspect_ratio)
 
-		# calling the function to create the accompanying scalebar
-		self._create_scalebar()
+		sb_thickness = int(h / self.scalebar_thickness_ratio)
+		self.resized((w,h), method).save(os.path.join(save_dir, f"{self.statistic}.png"))
+		self.scalebar.resize((sb_thickness, h)).save(os.path.join(save_dir, f"{self.statistic}_scalebar.png"))
 
 	def display_img(self, w=250):
 		"""
@@ -178,21 +344,18 @@ class HeatMap:
 		h = w * self.rmap.aspect_ratio
 		self.img.resize((w,h), self.resize_method).show()
 	
-	def _create_scalebar(self):
+	def _create_scalebar(self, lut=None):
 		"""
 		Method for creating accompanying scalebar for the heatmap
-		"""
-
-		# determining dimensions and creating the blank array
-		self.scalebar_thickness = self.gradient // self.scalebar_thickness_ratio
-		self.scalebar_array = np.zeros([len(self.col_array), self.scalebar_thickness], dtype=(float, 3))
-
-		# iterating through the color array and assigning values to the image array
-		for n, i in enumerate(self.col_array):
-			int_col = list(map(lambda x: int(x*255), i.get_rgb()))
-			for j in range(self.scalebar_thickness):
-				self.scalebar_array[len(self.col_array) - n - 1][j] = int_col
 
-		self.scalebar = Image.fromarray(np.uint8(self.scalebar_array), "RGB")
+		Parameters
+		----------
+		lut: color lookup table of the heatmap (rebuilt from the colors and gradient if not given)
+		"""
 
+		if lut is None:
+			lut = color_lut(self.start_color, self.end_color, self.gradient)
 
+		self.scalebar_thickness = self.gradient // self.scalebar_thickness_ratio
+		self.scalebar_array = render_scalebar(lut, self.scalebar_thickness)
+		self.scalebar = Image.fromarray(self.scalebar_array, "RGB")
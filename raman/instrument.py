@@ -0,0 +1,246 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+# instrumentation is switched on with the RAMAN_INSTRUMENT environment variable ('1' for timings and
+#  counters, 'memory' to also trace peak memory) or with enable(), when off every instrumented call
+#  only costs a check of this flag
+_enabled = os.environ.get("RAMAN_INSTRUMENT", "0").lower() not in ("", "0", "false")
+_memory = os.environ.get("RAMAN_INSTRUMENT", "").lower() == "memory"
+
+if _memory:
+	tracemalloc.start()
+
+_lock = threading.Lock()
+_stats = {}
+_local = threading.local()
+
+def enable(memory=False):
+	"""
+	Switches instrumentation on
+
+	Parameters
+	----------
+	memory: whether to also record the peak memory of each stage (uses tracemalloc, which slows
+	  down Python code considerably)
+	"""
+
+	global _enabled, _memory
+	_enabled = True
+	_memory = memory
+	if memory and not tracemalloc.is_tracing():
+		tracemalloc.start()
+
+def disable():
+	"""
+	Switches instrumentation off (recorded results are kept until reset)
+	"""
+
+	global _enabled, _memory
+	_enabled = False
+	if _memory and tracemalloc.is_tracing():
+		tracemalloc.stop()
+	_memory = False
+
+def enabled():
+	return _enabled
+
+def reset():
+	"""
+	Clears every recorded result
+	"""
+
+	with _lock:
+		_stats.clear()
+
+def _entry(name):
+	if name not in _stats:
+		_stats[name] = {"calls": 0, "seconds": 0.0, "peak_mb": None, "counters": {}}
+	return _stats[name]
+
+def count(name, counter, n=1):
+	"""
+	Adds to a counter of a stage (i.e. fit iterations or convergence failures)
+
+	Parameters
+	----------
+	name: name of the stage
+	counter: name of the counter
+	n: amount to add
+	"""
+
+	if not _enabled:
+		return
+	with _lock:
+		counters = _entry(name)["counters"]
+		counters[counter] = counters.get(counter, 0) + n
+
+class timed:
+	def __init__(self, name):
+		"""
+		Context manager recording the wall time (and peak memory if enabled) of a block of code as a
+		  call of the named stage
+
+		Parameters
+		----------
+		name: name of the stage
+		"""
+
+		self.name = name
+
+	def __enter__(self):
+		if not _enabled:
+			self.start = None
+			return self
+
+		# stages can be nested, the peak of an inner stage also counts towards the outer ones
+		self.peak = 0
+		if _memory and tracemalloc.is_tracing():
+			stack = getattr(_local, "stack", None)
+			if stack is None:
+				stack = _local.stack = []
+			if stack:
+				stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+			tracemalloc.reset_peak()
+			stack.append(self)
+
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		if self.start is None:
+			return False
+
+		seconds = time.perf_counter() - self.start
+		peak = None
+		stack = getattr(_local, "stack", None)
+		if stack and stack[-1] is self:
+			stack.pop()
+			peak = max(self.peak, tracemalloc.get_traced_memory()[1]) if tracemalloc.is_tracing() else None
+			if stack and peak is not None:
+				stack[-1].peak = max(stack[-1].peak, peak)
+
+		with _lock:
+			entry = _entry(self.name)
+			entry["calls"] += 1
+			entry["seconds"] += seconds
+			if peak is not None:
+				entry["peak_mb"] = max(entry["peak_mb"] or 0, peak / 2**20)
+		return False
+
+def stage(name=None):
+	"""
+	Decorator recording every call of a function as a call of a stage (named after the function by
+	  default, i.e. 'RamanMap.fit_peaks')
+
+	Parameters
+	----------
+	name: name of the stage
+	"""
+
+	def decorator(func):
+		label = name or func.__qualname__
+
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			if not _enabled:
+				return func(*args, **kwargs)
+			with timed(label):
+				return func(*args, **kwargs)
+		return wrapper
+	return decorator
+
+def snapshot():
+	"""
+	Copy of the recorded results, by stage
+	"""
+
+	with _lock:
+		return {k: {**v, "counters": dict(v["counters"])} for k, v in _stats.items()}
+
+def merge(stats):
+	"""
+	Adds results recorded elsewhere (i.e. by a worker process, see collect) to the recorded results
+
+	Parameters
+	----------
+	stats: dictionary returned by snapshot
+	"""
+
+	with _lock:
+		for name, s in stats.items():
+			entry = _entry(name)
+			entry["calls"] += s["calls"]
+			entry["seconds"] += s["seconds"]
+			if s["peak_mb"] is not None:
+				entry["peak_mb"] = max(entry["peak_mb"] or 0, s["peak_mb"])
+			for k, v in s["counters"].items():
+				entry["counters"][k] = entry["counters"].get(k, 0) + v
+
+def collect(func, *args, **kwargs):
+	"""
+	Calls a function with instrumentation switched on and returns its result together with what
+	  was recorded during the call (module level so it can be sent to worker processes, whose
+	  results are otherwise lost, pass the snapshot to merge in the parent process)
+
+	Returns
+	----------
+	result of the function, snapshot of the results recorded during the call
+	"""
+
+	enable(_memory)
+	reset()
+	result = func(*args, **kwargs)
+	return result, snapshot()
+
+def report():
+	"""
+	Recorded results as a list of rows, one per stage (slowest first), with the number of calls,
+	  total and mean wall time, peak memory and every counter
+	"""
+
+	rows = []
+	for name, s in snapshot().items():
+		rows.append({"stage": name,
+				"calls": s["calls"],
+				"seconds": s["seconds"],
+				"mean_ms": 1000 * s["seconds"] / s["calls"] if s["calls"] else None,
+				"peak_mb": s["peak_mb"],
+				**s["counters"]})
+	return sorted(rows, key=lambda r: -r["seconds"])
+
+def dump(save_dir, name="instrumentation"):
+	"""
+	Saves the recorded results as <name>.json and <name>.csv
+
+	Parameters
+	----------
+	save_dir: directory to save the report to
+	name: file name of the report, without extension
+	"""
+
+	rows = report()
+	with open(os.path.join(save_dir, f"{name}.json"), "w") as f:
+		json.dump(rows, f, indent=4)
+	pd.DataFrame(rows).to_csv(os.path.join(save_dir, f"{name}.csv"), index=False)
+
+def summary(n=3):
+	"""
+	One line summary of the slowest stages and the fit failures, i.e. for a status bar
+
+	Parameters
+	----------
+	n: number of stages to list
+	"""
+
+	rows = report()
+	text = ", ".join(f"{r['stage']} {r['seconds']:.2f} s" for r in rows[:n])
+	failures = sum(r.get("failures", 0) for r in rows)
+	if failures:
+		text += f", {failures} fit failures"
+	return text
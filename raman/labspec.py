@@ -0,0 +1,92 @@
+import numpy as np
+
+from raman import instrument
+
+
+def _separator(fpath):
+	"""
+	Determines the column separator of a LabSpec map file from its extension (.csv files are comma
+	  separated, .txt files are tab separated)
+
+	Parameters
+	----------
+	fpath: file path to map data
+	"""
+
+	if fpath.endswith(".csv"):
+		return ","
+	elif fpath.endswith(".txt"):
+		return "\t"
+	raise ValueError("Invalid file type, map files must be .csv or .txt")
+
+def scan_labspec(fpath):
+	"""
+	Reads the wavenumber header of a LabSpec map file and counts its spectra without parsing any
+	  intensities (allows for preallocating the intensity array)
+
+	Parameters
+	----------
+	fpath: file path to map data
+
+	Returns
+	----------
+	numpy array of wavenumbers, number of spectra in the map
+	"""
+
+	sep = _separator(fpath)
+
+	# LabSpec .csv exports start with a UTF-8 byte order mark, utf-8-sig strips it if present
+	with open(fpath, "r", encoding="utf-8-sig") as f:
+		wavenums = np.array(f.readline().rstrip("\r\n").split(sep)[2:], dtype=float)
+		n_spectra = sum(1 for line in f if line.strip())
+
+	return wavenums, n_spectra
+
+@instrument.stage()
+def read_labspec(fpath, out=None, dtype=float, progress=None):
+	"""
+	Loads a HORIBA LabSpec map file, where the first row holds the wavenumbers and each following
+	  row holds the stage X and Y position followed by the intensities of one spectrum
+
+	Each row is parsed straight into a preallocated array, so the map is never held as a DataFrame
+	  or transposed
+
+	Parameters
+	----------
+	fpath: file path to map data (.csv or tab separated .txt)
+	out: optional preallocated array of shape (number of spectra, number of wavenumbers) to write
+	  the intensities into (i.e. a numpy memmap)
+	dtype: data type of the intensity array when out is not given (default float64)
+	progress: optional callback, called as progress(stage, done, total) every 1024 spectra
+
+	Returns
+	----------
+	wavenumbers, x positions, y positions, and the 2-D intensity array (one row per spectrum)
+	"""
+
+	sep = _separator(fpath)
+	wavenums, n_spectra = scan_labspec(fpath)
+
+	if out is None:
+		out = np.empty((n_spectra, len(wavenums)), dtype=dtype)
+	elif out.shape != (n_spectra, len(wavenums)):
+		raise ValueError(f"Invalid shape, 'out' must have shape {(n_spectra, len(wavenums))}")
+
+	x = np.empty(n_spectra)
+	y = np.empty(n_spectra)
+
+	with open(fpath, "r", encoding="utf-8-sig") as f:
+		f.readline()
+		i = 0
+		for line in f:
+			if not line.strip():
+				continue
+			row = np.fromstring(line, dtype=float, sep=sep)
+			x[i] = row[0]
+			y[i] = row[1]
+			out[i] = row[2:]
+			i += 1
+			if progress and (i % 1024 == 0 or i == n_spectra):
+				progress("Reading map", i, n_spectra)
+
+	return wavenums, x, y, out
@@ -0,0 +1,105 @@
+import threading
+
+import numpy as np
+
+from raman.utils import remove_baseline
+
+
+class LazyIntensities:
+	def __init__(self, raw, chunk_size=1024, dtype=float, **kwargs):
+		"""
+		Baseline-corrected intensities of a map that are only corrected when they are first read, one
+		  chunk of spectra at a time (corrected chunks are kept, so every chunk is corrected once)
+
+		Indexing works like indexing the corrected 2-D array (the first index selects spectra, i.e.
+		  intensities[i], intensities[start:stop] or intensities[indices]), and np.asarray() corrects
+		  every remaining chunk and returns the whole array
+
+		Parameters
+		----------
+		raw: 2-D array of raw intensities (one row per spectrum)
+		chunk_size: number of spectra corrected at a time
+		dtype: data type of the corrected intensities
+		kwargs: keyword arguments passed on to baseline_als_batch (lam, p, niter)
+		"""
+
+		self.raw = raw
+		self.chunk_size = chunk_size
+		self.bline_params = kwargs
+
+		# the pages of the corrected array are only allocated once a chunk is written to them
+		self.corrected = np.empty(raw.shape, dtype=dtype)
+		self.done = np.zeros(-(-len(raw) // chunk_size), dtype=bool)
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.raw)
+
+	@property
+	def shape(self):
+		return self.corrected.shape
+
+	@property
+	def dtype(self):
+		return self.corrected.dtype
+
+	@property
+	def ndim(self):
+		return self.corrected.ndim
+
+	@property
+	def nbytes(self):
+		return self.corrected.nbytes
+
+	@property
+	def complete(self):
+		"""
+		Whether every chunk has been corrected
+		"""
+
+		return bool(np.all(self.done))
+
+	def chunks(self, rows):
+		"""
+		Indices of the chunks holding the given spectra
+
+		Parameters
+		----------
+		rows: index of the spectra, an integer, slice, integer array or boolean mask
+		"""
+
+		n = len(self)
+		if isinstance(rows, slice):
+			rows = np.arange(*rows.indices(n))
+		elif rows is Ellipsis:
+			return np.arange(len(self.done))
+		else:
+			rows = np.asarray(rows)
+			if rows.dtype == bool:
+				rows = np.flatnonzero(rows)
+		return np.unique(rows.astype(int) % n // self.chunk_size) if n else rows.astype(int)
+
+	def correct(self, chunks=None):
+		"""
+		Removes the baseline of the given chunks, unless they were corrected before
+
+		Parameters
+		----------
+		chunks: indices of the chunks to correct (default all of them)
+		"""
+
+		chunks = np.arange(len(self.done)) if chunks is None else chunks
+		with self._lock:
+			for c in chunks:
+				if not self.done[c]:
+					s = slice(c * self.chunk_size, (c + 1) * self.chunk_size)
+					remove_baseline(self.raw[s], out=self.corrected[s], chunk_size=self.chunk_size, **self.bline_params)
+					self.done[c] = True
+
+	def __getitem__(self, key):
+		self.correct(self.chunks(key[0] if isinstance(key, tuple) else key))
+		return self.corrected[key]
+
+	def __array__(self, dtype=None, copy=None):
+		self.correct()
+		return self.corrected if dtype is None else self.corrected.astype(dtype)
@@ -1,5 +1,12 @@
+import numpy as np
+
+from raman import instrument
+from raman.fitting import PROFILES
+from raman.utils import subset_bounds
+
+
 class Material:
-	def __init__(self, name, peaks, snr_sample_region):
+	def __init__(self, name, peaks, snr_sample_region, bands=None, shape="lorentzian"):
 		"""
 		Data container for material characteristics
 
@@ -10,8 +17,121 @@ class Material:
 		  indicating start/stop wavenumbers of peak range
 		snr_sample_region: flat region of spectrum to take signal to noise ratio (should be array of
 		  length 2 with start/stop wavenumbers)
+		bands: optional dictionary of peak windows holding several overlapping bands (i.e. D' next to
+		  G), where keys are peak names and values are dictionaries of band names and approximate band
+		  locations, every other window holds a single band named after the peak
+		shape: line shape of the bands, 'lorentzian', 'pseudo-voigt' or 'voigt' (only used by joint
+		  fitting, see RamanMap.fit_peaks)
 		"""
 
+		if shape not in PROFILES:
+			raise ValueError("Invalid shape, must be 'lorentzian', 'pseudo-voigt' or 'voigt'")
+
 		self.name = name
 		self.peaks = peaks
 		self.snr_sample_region = snr_sample_region
+		self.shape = shape
+
+		# band name -> approximate location (None if located at the maximum) for every peak window
+		self.bands = {k: {b: (None if l is None else float(l)) for b, l in bands[k].items()} 
+				if bands and k in bands else {k: None} for k in peaks}
+		for k, v in self.bands.items():
+			if len(v) > 1 and None in v.values():
+				raise ValueError(f"Every band of peak window {k} needs an approximate location")
+
+	def band_names(self, peaks=None):
+		"""
+		Names of the bands of the given peak windows (default all), in fitting order
+
+		Parameters
+		----------
+		peaks: list of peak names (keys of peaks)
+		"""
+
+		return [b for k in (peaks or self.peaks) for b in self.bands[k]]
+
+	def single_bands(self, peaks=None):
+		"""
+		Whether every given peak window (default all) holds a single Lorentzian band, so it can be
+		  fitted one window at a time
+		"""
+
+		return self.shape == "lorentzian" and all(len(self.bands[k]) == 1 for k in (peaks or self.peaks))
+
+
+class MaterialIndex:
+	def __init__(self, wavenums, material):
+		"""
+		Resolves the peak windows and signal-to-noise window of a material to index bounds on a 
+		  wavenumber axis, so they only have to be looked up once for all spectra sharing the axis
+
+		Windows are stored as slices (so indexing the intensities gives views rather than copies) 
+		  for ascending or descending axes, and as index arrays for irregular (unsorted) axes
+
+		Parameters
+		----------
+		wavenums: numpy array holding the wavenumber axis
+		material: Material class containing information about your material
+		"""
+
+		self.wavenums = np.asarray(wavenums)
+		self.material = material
+
+		self.peak_windows = {k: self._resolve(*v) for k, v in material.peaks.items()}
+		self.snr_window = self._resolve(*material.snr_sample_region)
+
+	def _resolve(self, start_wavenum, end_wavenum):
+		"""
+		Finds the indices of the wavenumbers inside a window (matching utils.subset on ascending axes)
+
+		Parameters
+		----------
+		start_wavenum: wavenumber at beginning of window
+		end_wavenum: wavenumber at end of window
+		"""
+
+		w = self.wavenums
+		steps = np.diff(w)
+
+		if np.all(steps > 0):
+			start_index, end_index = subset_bounds(w, start_wavenum, end_wavenum)
+			return slice(int(start_index), int(end_index))
+		elif np.all(steps < 0):
+			# resolving on the ascending (reversed) axis and mapping the bounds back
+			start_index, end_index = subset_bounds(w[::-1], start_wavenum, end_wavenum)
+			return slice(int(len(w) - end_index), int(len(w) - start_index))
+
+		# like subset, a window running past the end of the axis stops before the last wavenumber
+		end_wavenum = min(end_wavenum, np.max(w))
+		return np.flatnonzero((w >= start_wavenum) & (w < end_wavenum))
+
+	def peak(self, intensities, name):
+		"""
+		Selects a peak window of one spectrum or of every spectrum in a 2-D intensity array
+
+		Parameters
+		----------
+		intensities: 1-D spectrum or 2-D array with one spectrum per row
+		name: name of the peak (key of material.peaks)
+
+		Returns
+		----------
+		wavenumbers and intensities of the window
+		"""
+
+		window = self.peak_windows[name]
+		return self.wavenums[window], intensities[..., window]
+
+	@instrument.stage()
+	def signal_noise_ratio(self, intensities):
+		"""
+		Calculates the signal to noise ratio of one spectrum or of every spectrum in a 2-D intensity
+		  array (max intensity divided by the standard deviation of the signal-to-noise window, 
+		  accumulated in float64 for single precision intensities)
+
+		Parameters
+		----------
+		intensities: 1-D spectrum or 2-D array with one spectrum per row
+		"""
+
+		return np.max(intensities, axis=-1) / np.std(intensities[..., self.snr_window], axis=-1, dtype=np.float64)
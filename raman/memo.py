@@ -0,0 +1,202 @@
+from collections import OrderedDict
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+
+class FitMemo:
+	def __init__(self, maxsize=100000, path=None):
+		"""
+		Memoizes fit results by a hash of the fitted data and the fit settings, in a bounded in-memory
+		  LRU with an optional on-disk tier (an SQLite file that can be shared by processes and
+		  sessions)
+
+		Values are float arrays (or None for fits that failed to converge, so failing fits are not
+		  retried either)
+
+		Parameters
+		----------
+		maxsize: maximum number of results kept in memory (0 disables the in-memory tier)
+		path: optional path of the on-disk tier
+		"""
+
+		self.enabled = True
+		self.maxsize = maxsize
+		self.path = path
+		self.hits = 0
+		self.misses = 0
+
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self._db = None
+		self._db_pid = None
+		self._pending = 0
+		self._recording = None
+
+	@staticmethod
+	def key(settings, *arrays):
+		"""
+		Creates the key of a fit from its settings and the arrays it depends on
+
+		Parameters
+		----------
+		settings: string describing the fit (i.e. model and fitting method)
+		arrays: arrays the fit result depends on (i.e. x, y and the initial guess)
+		"""
+
+		h = hashlib.blake2b(settings.encode(), digest_size=16)
+		for a in arrays:
+			a = np.ascontiguousarray(a, dtype=float)
+			h.update(str(a.shape).encode())
+			h.update(a.tobytes())
+		return h.digest()
+
+	def _connect(self):
+		# connections can not be shared with forked worker processes, each process opens its own
+		if self._db is None or self._db_pid != os.getpid():
+			self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+			self._db.execute("PRAGMA journal_mode=WAL")
+			self._db.execute("PRAGMA synchronous=OFF")
+			self._db.execute("CREATE TABLE IF NOT EXISTS fits (key BLOB PRIMARY KEY, value BLOB)")
+			self._db_pid = os.getpid()
+			self._pending = 0
+		return self._db
+
+	def get(self, key):
+		"""
+		Looks up a fit result
+
+		Parameters
+		----------
+		key: key created by key()
+
+		Returns
+		----------
+		whether the result was found, the result
+		"""
+
+		with self._lock:
+			if key in self._entries:
+				self._entries.move_to_end(key)
+				self.hits += 1
+				return True, self._entries[key]
+
+			if self.path:
+				row = self._connect().execute("SELECT value FROM fits WHERE key = ?", (key,)).fetchone()
+				if row is not None:
+					value = None if row[0] is None else np.frombuffer(row[0], dtype=float)
+					self._remember(key, value)
+					self.hits += 1
+					return True, value
+
+			self.misses += 1
+			return False, None
+
+	def _remember(self, key, value):
+		if self.maxsize <= 0:
+			return
+		self._entries[key] = value
+		self._entries.move_to_end(key)
+		while len(self._entries) > self.maxsize:
+			self._entries.popitem(last=False)
+
+	def put(self, key, value):
+		"""
+		Stores a fit result
+
+		Parameters
+		----------
+		key: key created by key()
+		value: float array, or None for a failed fit
+		"""
+
+		value = None if value is None else np.array(value, dtype=float)
+		with self._lock:
+			self._remember(key, value)
+
+			# while recording (in a worker process) new results are handed back to the parent process,
+			#  which writes them to disk
+			if self._recording is not None:
+				self._recording.append((key, value))
+			elif self.path:
+				self._connect().execute("INSERT OR REPLACE INTO fits VALUES (?, ?)",
+						(key, None if value is None else value.tobytes()))
+				self._pending += 1
+				if self._pending >= 1024:
+					self._db.commit()
+					self._pending = 0
+
+	def lookup(self, key, compute):
+		"""
+		Returns the memoized result of a key, computing and storing it if there is none
+
+		Parameters
+		----------
+		key: key created by key()
+		compute: function without arguments returning the result (a float array or None)
+
+		Returns
+		----------
+		whether the result was memoized, the result
+		"""
+
+		found, value = self.get(key)
+		if not found:
+			value = compute()
+			self.put(key, value)
+		return found, value
+
+	def update(self, entries):
+		"""
+		Stores many (key, value) fit results, i.e. those recorded by a worker process
+		"""
+
+		for key, value in entries:
+			self.put(key, value)
+
+	def record(self):
+		"""
+		Starts recording the results stored from now on (see recorded)
+		"""
+
+		self._recording = []
+
+	def recorded(self):
+		"""
+		Stops recording and returns the recorded (key, value) results
+		"""
+
+		entries, self._recording = self._recording or [], None
+		return entries
+
+	def flush(self):
+		"""
+		Commits results waiting to be written to the on-disk tier
+		"""
+
+		with self._lock:
+			if self._db is not None and self._db_pid == os.getpid() and self._pending:
+				self._db.commit()
+				self._pending = 0
+
+	def clear(self):
+		"""
+		Empties the in-memory tier (the on-disk tier is kept)
+		"""
+
+		with self._lock:
+			self._entries.clear()
+			self.hits = 0
+			self.misses = 0
+
+	def __len__(self):
+		return len(self._entries)
+
+# memo used by fit_lorentzian, the on-disk tier is enabled by setting the RAMAN_FIT_CACHE environment
+#  variable to the path of the file (or by setting fit_memo.path)
+fit_memo = FitMemo(path=os.environ.get("RAMAN_FIT_CACHE") or None)
+atexit.register(fit_memo.flush)
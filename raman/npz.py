@@ -0,0 +1,58 @@
+import json
+import os
+
+import numpy as np
+
+
+def atomic_savez(path, header, arrays, compressed=False):
+	"""
+	Saves a dictionary header (as JSON) and named arrays to an .npz file, writing to a temporary file
+	  first so an interrupted save never leaves a corrupt file (saving is skipped when the directory
+	  is not writable)
+
+	Parameters
+	----------
+	path: path of the .npz file
+	header: JSON-serializable dictionary identifying the contents (see load_keyed_npz)
+	arrays: dictionary of arrays
+	compressed: whether to compress the arrays
+	"""
+
+	tmp_path = f"{path}.tmp.npz"
+	try:
+		(np.savez_compressed if compressed else np.savez)(tmp_path, header=json.dumps(header), **arrays)
+		os.replace(tmp_path, path)
+	except OSError:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+
+def load_keyed_npz(path, key, validate=None):
+	"""
+	Loads an .npz file saved by atomic_savez if every entry of key matches its header (missing,
+	  unreadable or incomplete files are treated as not matching)
+
+	Parameters
+	----------
+	path: path of the .npz file
+	key: dictionary of header entries that must match
+	validate: optional function of the header returning whether it matches, called after the
+	  entries of key matched (for expensive checks, i.e. hashing the file a cache was made from)
+
+	Returns
+	----------
+	header dictionary and dictionary of the arrays, or None if there is no matching file
+	"""
+
+	if not os.path.exists(path):
+		return None
+
+	try:
+		with np.load(path) as data:
+			header = json.loads(str(data["header"]))
+			if any(header.get(k) != v for k, v in key.items()):
+				return None
+			if validate is not None and not validate(header):
+				return None
+			return header, {k: data[k] for k in data.files if k != "header"}
+	except (OSError, ValueError, KeyError):
+		return None
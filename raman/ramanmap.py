@@ -1,38 +1,228 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property, partial
 import os
 import random
+import re
 
-from colour import Color
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import numpy as np
 import pandas as pd
 from PIL import Image
 
-from raman.config import GRAPHENE
+from raman import instrument
+from raman.cache import create_mmap, load_cache, load_mmap, save_cache
+from raman.fitting import fit_bands_batch, PROFILES
+from raman.grid import GridIndex
+from raman.heatmap import color_bins, color_lut, render_heatmap
+from raman.labspec import read_labspec
+from raman.lazy import LazyIntensities
+from raman.material import MaterialIndex
+from raman.memo import fit_memo
 from raman.ramanspectrum import RamanSpectrum
-from raman.utils import find_index, fit_lorentzian, lorentzian, summ_stats
+from raman.render import BadSpectraRenderer
+from raman.results import load_results, results_key, results_path, save_results, spectrum_hashes
+from raman.utils import (fit_lorentzian, fit_lorentzian_batch, guess_lorentzian, lorentzian,
+	remove_baseline, SpectrumAccumulator, summ_stats)
+
+# number of spectra fitted per chunk (chunks are the unit of work sent to worker processes, and
+#  are the same whether fitting serially or in parallel so the results are identical)
+FIT_CHUNK_SIZE = 256
+
+def _fit_chunk(windows, positions=None):
+	"""
+	Fits a Lorentzian to each peak window of a chunk of spectra (module level so it can be sent
+	  to worker processes)
+
+	Parameters
+	----------
+	windows: list of (wavenumbers, intensities) tuples, one per peak, where intensities is a 2-D
+	  array holding the peak window of every spectrum in the chunk
+	positions: optional (rows, cols) arrays giving the grid position of each spectrum, if given
+	  each fit starts from the parameters of an already fitted neighbouring pixel (or from a 
+	  data-driven guess when there is none) instead of the default initial guess, so spectra
+	  should be ordered such that neighbours follow each other
+
+	Returns
+	----------
+	arrays of shape (number of spectra, number of peaks, 3) holding the fitted amplitude, gamma and
+	  peak location, and their standard errors (NaN where the fit failed to converge)
+	"""
+
+	n_spectra = len(windows[0][1])
+	params = np.full((n_spectra, len(windows), 3), np.nan)
+	errors = np.full((n_spectra, len(windows), 3), np.nan)
+
+	# grid position -> index in chunk of every pixel fitted so far
+	fitted = {}
+
+	for i in range(n_spectra):
+		neighbours = []
+		if positions is not None:
+			r, c = positions[0][i], positions[1][i]
+			neighbours = [fitted[k] for k in [(r, c-1), (r, c+1), (r-1, c), (r+1, c)] if k in fitted]
+
+		for j, (x, y) in enumerate(windows):
+			if positions is None:
+				p = fit_lorentzian(x, y[i], full_output=True)
+				if p is not None:
+					params[i, j], errors[i, j] = p
+			else:
+				seeds = [params[n, j] for n in neighbours if not np.isnan(params[n, j]).any()]
+
+				def fit():
+					for p0 in seeds[:1] + [guess_lorentzian(x, y[i])]:
+						p = fit_lorentzian(x, y[i], p0, full_output=True, memo=False)
+						if p is not None:
+							return np.concatenate(p)
+					return None
+
+				# the seed is part of the key, so a memoized fit is exactly what fitting again would give
+				#  (the seeds of an unchanged map are the same every time, so refits still hit)
+				if fit_memo.enabled:
+					key = fit_memo.key("lorentzian/curve_fit/warm_start", x, y[i], np.asarray(seeds[:1]).reshape(-1))
+					found, p = fit_memo.lookup(key, fit)
+					if found:
+						instrument.count("fit_lorentzian", "memo_hits")
+				else:
+					p = fit()
+				if p is not None:
+					params[i, j], errors[i, j] = p[:3], p[3:]
+
+		if positions is not None:
+			fitted[(r, c)] = i
+	return params, errors
+
+def _fit_chunk_remote(instrumented, windows, positions=None):
+	"""
+	Runs _fit_chunk in a worker process, returning the fit results memoized by the worker (and what
+	  it recorded if instrumentation is on) along with the parameters, so the parent process keeps
+	  them
+
+	Parameters
+	----------
+	instrumented: whether instrumentation is switched on in the parent process
+	windows: see _fit_chunk
+	positions: see _fit_chunk
+	"""
+
+	fit_memo.record()
+	if instrumented:
+		result, stats = instrument.collect(_fit_chunk, windows, positions)
+	else:
+		result, stats = _fit_chunk(windows, positions), None
+	return result, fit_memo.recorded(), stats
+
+def band_key(band):
+	"""
+	Lowercase name of a band usable in statistic and file names (i.e. 2D becomes 2d, D' becomes
+	  d_prime)
+	"""
+
+	return re.sub(r"\W+", "_", band.lower().replace("'", "_prime")).strip("_")
+
+def band_statistics(material):
+	"""
+	Names of the statistics RamanMap.data_summary calculates for a material, the location, full width 
+	  at half maximum and height of every band (i.e. peak_loc_g, fwhm_g and height_g)
+
+	Parameters
+	----------
+	material: Material class containing information about your material
+	"""
+
+	return [f"{s}_{band_key(b)}" for b in material.band_names() for s in ["peak_loc", "fwhm", "height"]]
 
 class RamanMap:
-	def __init__(self, fpath, material):
+	# names of the per-spectrum statistics the map calculates, subclasses extend this (each one becomes
+	#  a float column of spectra_characteristics), when empty the statistics of every band of the
+	#  material are calculated (see band_statistics)
+	statistics = []
+
+	@instrument.stage()
+	def __init__(self, fpath, material, bline_params=None, cache=True, out_of_core=False, chunk_size=1024,
+			progress=None, store=True, dtype=float, lazy=False):
 		"""
 		Main map class from which other map classes inherit
 
+		Spectra are stored column-wise: intensities is a single 2-D array (one row per spectrum) 
+		  sharing the wavenums axis, and spectra_characteristics is a structured array with one
+		  record per spectrum (x, y, present, snr, raw_intensity, fitted, fit_failed and each statistic), 
+		  so whole columns can be read with i.e. spectra_characteristics["x"]
+
+		The mean raw intensity of every spectrum (raw_intensity) is known as soon as the map is parsed,
+		  so it can be shown (i.e. create_heatmap("raw_intensity", ...)) before any processing is done
+
 		Parameters
 		----------
 		fpath: file path to map data
 		material: Material class containing information about your material
+		bline_params: dictionary of baseline_als parameters (lam, p, niter), defaults are used for
+		  any that are missing
+		cache: whether to reuse (and create) a binary cache of the parsed and baseline-corrected
+		  map stored next to the map file
+		out_of_core: if True the map is converted once into memory-mapped arrays stored next to the
+		  map file and intensities are read from disk as needed, only the per-spectrum results are
+		  kept in memory (for maps larger than RAM)
+		chunk_size: number of spectra processed at a time (baseline removal, noise checks, averaging)
+		progress: optional callback, called as progress(stage, done, total) with the number of spectra
+		  processed so far (an exception raised by the callback aborts loading)
+		store: whether to reuse (and save) the fit results of earlier analyses of the map, stored
+		  next to the map file, so only spectra that changed or were never fitted are fitted again
+		dtype: data type of the intensities, np.float32 halves their memory and bandwidth (baseline
+		  solves, signal-to-noise sums and fits are still done in float64, see 
+		  benchmarks/accuracy.py for the effect on the statistics)
+		lazy: if True only the coordinates and raw intensities are parsed, baselines are removed the
+		  first time a chunk of spectra is read and signal-to-noise ratios are calculated by process()
+		  (which data_summary calls), so large maps open quickly (maps loaded from a cache or 
+		  out-of-core are already corrected)
 		"""
 
 		self.fpath = fpath
 		self.material = material
-
-		# allowing for loading either .csv or .txt files
-		if self.fpath.endswith(".csv"):
-			self.df = pd.read_csv(fpath, header=None)
-		elif self.fpath.endswith(".txt"):
-			self.df = pd.read_csv(fpath, header=None, sep="\t")
-
-		self.x = np.array(self.df.iloc[1:, 0])
-		self.y = np.array(self.df.iloc[1:, 1])
+		self.bline_params = {"lam": 10000, "p": 0.001, "niter": 10, **(bline_params or {})}
+		self.chunk_size = chunk_size
+		self.store = store
+		self.dtype = np.dtype(dtype)
+		if not self.statistics:
+			self.statistics = band_statistics(material)
+
+		if out_of_core:
+			cached = load_mmap(fpath, self.bline_params, dtype) or create_mmap(fpath, 
+					self.bline_params, 
+					chunk_size,
+					dtype,
+					progress=progress)
+		else:
+			cached = load_cache(fpath, self.bline_params, dtype) if cache else None
+
+		if cached:
+			self.wavenums = cached["wavenums"]
+			self.x = cached["x"]
+			self.y = cached["y"]
+			self.intensities = cached["corrected"]
+			raw = cached["raw"]
+		else:
+			# allowing for loading either .csv or .txt files, intensities are parsed straight into a
+			#  2-D array with one row per spectrum
+			self.wavenums, self.x, self.y, raw = read_labspec(fpath, dtype=dtype, progress=progress)
+
+			if lazy:
+				self.intensities = LazyIntensities(raw, chunk_size, dtype, **self.bline_params)
+			else:
+				# removing the baseline of every spectrum in batched passes (all spectra share the same
+				#  wavenumber axis, so the smoothness penalty only has to be built once per batch)
+				self.intensities = remove_baseline(raw, 
+						chunk_size=chunk_size, 
+						progress=progress, 
+						dtype=dtype, 
+						**self.bline_params)
+
+				if cache:
+					save_cache(fpath, self.bline_params, self.wavenums, self.x, self.y, raw, self.intensities)
+
+		# lazily corrected maps are cached once process() has corrected every spectrum
+		self._save_cache = cache and isinstance(self.intensities, LazyIntensities)
 
 		self.min_x = np.min(self.x)
 		self.max_x = np.max(self.x)
@@ -42,47 +232,459 @@ class RamanMap:
 		self.width = self.max_x - self.min_x
 		self.height = self.max_y - self.min_y
 		self.aspect_ratio = self.height / self.width
-		self.unique_x = len(set(self.x))
-		self.unique_y = len(set(self.y))
-
-		self.x_step = self.width / (self.unique_x-1)
-		self.y_step = self.height / (self.unique_y-1)
-
-		self.data = self.df.iloc[:, 2:].transpose()
-		self.wavenums = self.data.iloc[:, 0]
-		self.intensities = self.data.iloc[:, 1:]
-
-		# creating a RamanSpectrum object for each spectrum in map
-		self.spectra = [RamanSpectrum(self.wavenums, 
-			self.intensities.iloc[:, i], 
-			self.material) for i in range(len(self.intensities.columns))]
-		
-		self.spectra_characteristics = [{"present": True,
-			"x": self.x[i],
-			"y": self.y[i]} for i in range(len(self.spectra))]
+
+		# integer grid position of every spectrum, shared by all heatmap and spatial code
+		self.grid = GridIndex(self.x, self.y)
+		self.unique_y, self.unique_x = self.grid.shape
+		self.x_step = self.grid.x_step
+		self.y_step = self.grid.y_step
+
+		# peak and signal-to-noise windows resolved once for the shared wavenumber axis
+		self.index = MaterialIndex(self.wavenums, self.material)
+
+		self.spectra_characteristics = np.zeros(len(self.intensities), 
+				dtype=[("x", float), ("y", float), ("present", bool), ("snr", float), ("raw_intensity", float),
+					("fitted", bool), ("fit_failed", bool)] + [(i, float) for i in self.statistics])
+		self.spectra_characteristics["x"] = self.x
+		self.spectra_characteristics["y"] = self.y
+		self.spectra_characteristics["present"] = True
+		self.spectra_characteristics["snr"] = np.nan
+		for start in range(0, len(raw), chunk_size):
+			self.spectra_characteristics["raw_intensity"][start:start+chunk_size] = np.mean(raw[start:start+chunk_size], 
+					axis=1, 
+					dtype=np.float64)
+
+		# chunks of chunk_size spectra whose signal-to-noise ratio has been calculated (see process)
+		self._processed = np.zeros(-(-len(self) // chunk_size), dtype=bool)
+
+		# fitted amplitude, gamma and location (and any other shape parameter) of each band of the 
+		#  material for every spectrum, and their standard errors
+		shape = (len(self.intensities), len(self.material.band_names()), PROFILES[self.material.shape].n_params)
+		self.fit_params = np.full(shape, np.nan)
+		self.fit_errors = np.full(shape, np.nan)
+		self._fit_settings = None
+
+		# renderer of the rejected spectra saved by remove_noisy
+		self.bad_spectra = None
+
+		if not lazy:
+			self.process(progress)
 	
 	def __len__(self):
-		return len(self.spectra)
+		return len(self.intensities)
+
+	@instrument.stage()
+	def process(self, progress=None):
+		"""
+		Calculates the signal-to-noise ratio of every spectrum that has not been processed yet, chunk by
+		  chunk so memory-mapped maps are never read into memory at once (for lazily loaded maps the
+		  baselines of each chunk are removed first, and the map is cached once every spectrum is
+		  corrected)
+
+		Parameters
+		----------
+		progress: optional callback, called as progress(stage, done, total) with the number of spectra
+		  processed so far (an exception raised by the callback stops processing, the chunks done
+		  so far are kept)
+		"""
+
+		lazy = isinstance(self.intensities, LazyIntensities)
+		stage = "Removing baselines" if lazy else "Calculating signal-to-noise"
+		sizes = np.diff(np.minimum(np.arange(len(self._processed) + 1) * self.chunk_size, len(self)))
+
+		for c in np.flatnonzero(~self._processed):
+			s = slice(c * self.chunk_size, (c + 1) * self.chunk_size)
+			self.spectra_characteristics["snr"][s] = self.index.signal_noise_ratio(self.intensities[s])
+			self._processed[c] = True
+			if progress:
+				progress(stage, int(np.sum(sizes[self._processed])), len(self))
+
+		if lazy:
+			lazy_intensities = self.intensities
+			if self._save_cache:
+				save_cache(self.fpath, 
+						self.bline_params, 
+						self.wavenums, 
+						self.x, 
+						self.y, 
+						lazy_intensities.raw, 
+						lazy_intensities.corrected)
+				self._save_cache = False
+
+			# every spectrum is corrected now, so the raw intensities are no longer needed
+			self.intensities = lazy_intensities.corrected
+
+	@cached_property
+	def spectrum_hashes(self):
+		"""
+		Hash of every baseline-corrected spectrum (calculated on first access), identifies the spectra
+		  whose saved results can be reused
+		"""
+
+		return spectrum_hashes(self.intensities, self.chunk_size)
+
+	def _results_columns(self):
+		return ["snr", "present", "fitted", "fit_failed"] + list(self.statistics)
+
+	def save_results(self, path=None, thresh=None):
+		"""
+		Saves the per-spectrum results (signal-to-noise ratio, present mask, fit parameters, their
+		  standard errors and every statistic) as a compressed columnar .npz file
+
+		Parameters
+		----------
+		path: path of the results file (default <map file>.results.npz)
+		thresh: signal-to-noise threshold the present mask was made with (recorded in the file)
+		"""
+
+		sc = self.spectra_characteristics
+		header = {**results_key(self.bline_params, self.material, self.statistics),
+				"fit_settings": list(self._fit_settings) if self._fit_settings else None,
+				"thresh": thresh}
+		arrays = {"hashes": self.spectrum_hashes,
+				"x": self.x,
+				"y": self.y,
+				"fit_params": self.fit_params,
+				"fit_errors": self.fit_errors}
+		arrays.update({f"sc_{k}": sc[k] for k in self._results_columns()})
+		save_results(path or results_path(self.fpath), header, arrays)
+
+	def load_results(self, path=None, fit_settings=None):
+		"""
+		Loads saved per-spectrum results, reusing them for every spectrum whose position and 
+		  baseline-corrected intensities are unchanged (all other spectra are left to be fitted)
+
+		Parameters
+		----------
+		path: path of the results file (default <map file>.results.npz)
+		fit_settings: optional (method, warm_start) tuple, results fitted with other settings are not
+		  loaded
+
+		Returns
+		----------
+		number of spectra whose results were reused
+		"""
 
+		loaded = load_results(path or results_path(self.fpath), 
+				results_key(self.bline_params, self.material, self.statistics))
+		if loaded is None:
+			return 0
+
+		header, data = loaded
+		settings = tuple(header["fit_settings"]) if header["fit_settings"] else None
+		if settings is None or (fit_settings is not None and settings != tuple(fit_settings)):
+			return 0
+
+		# spectra are matched by index, a spectrum is reused when neither its position nor its
+		#  intensities changed
+		n = min(len(self), len(data["hashes"]))
+		same = np.zeros(len(self), dtype=bool)
+		same[:n] = ((data["hashes"][:n] == self.spectrum_hashes[:n]) 
+				& (data["x"][:n] == self.x[:n]) 
+				& (data["y"][:n] == self.y[:n]))
+		same[:n] &= data["sc_fitted"][:n]
+
+		sc = self.spectra_characteristics
+		for k in self._results_columns():
+			sc[k][same] = data[f"sc_{k}"][:n][same[:n]]
+		self.fit_params[same] = data["fit_params"][:n][same[:n]]
+		self.fit_errors[same] = data["fit_errors"][:n][same[:n]]
+		self._fit_settings = settings
+
+		return int(np.sum(same))
+
+	def spectrum(self, i):
+		"""
+		Creates a RamanSpectrum view of a single spectrum of the map (the intensities are not copied)
+
+		Parameters
+		----------
+		i: index of the spectrum
+		"""
+
+		return RamanSpectrum(self.wavenums, 
+				self.intensities[i], 
+				self.material, 
+				remove_baseline=False, 
+				index=self.index)
+
+	@instrument.stage()
 	def remove_noisy(self, thresh=15, savebad=None):
 		"""
-		removes raman spectra that have a signal-to-noise ratio below the threshold
+		removes raman spectra that have a signal-to-noise ratio below the threshold (spectra that
+		  were removed by a previous call with a higher threshold are restored, unless their peaks
+		  failed to fit)
 
 		parameters
 		----------
 		thresh: signal-to-noise threshold below which to exclude (default 15)
 		savebad: provides ability to save rejected spectra to assure the 
-		  threshold is set correctly (should be a path to a directory where you want to save the images)
+		  threshold is set correctly (should be a path to a directory where you want to save the images,
+		  or a BadSpectraRenderer for control over resolution, number of images and contact sheets), 
+		  the images are rendered in the background, call bad_spectra.wait() to wait for them (and
+		  to get any rendering error), the renderer of a previous call saving to the same directory
+		  is reused and any other one is shut down once its queued images are rendered
 		"""
 
-		for i, s in enumerate(self.spectra):
-			if s.snr < thresh:
-				self.spectra_characteristics[i]["present"] = False
-				if savebad:
-					s.plot_spec()
-					plt.savefig(os.path.join(savebad, f"{i}_{int(s.snr)}.png"), dpi=300)
-					plt.close()
+		self.process()
+
+		sc = self.spectra_characteristics
+		snr = sc["snr"]
+		sc["present"] = (snr >= thresh) & ~sc["fit_failed"]
+
+		if savebad:
+			previous = self.bad_spectra
+			if isinstance(savebad, BadSpectraRenderer):
+				renderer = savebad
+			elif previous is not None and previous.savedir == savebad:
+				renderer = previous
+			else:
+				renderer = BadSpectraRenderer(savebad)
+			if previous is not None and previous is not renderer:
+				previous.shutdown(wait=False)
+			self.bad_spectra = renderer
+
+			# only the spectra that will be rendered are read (maps may be memory-mapped)
+			bad = np.flatnonzero(snr < thresh)
+			if renderer.max_count is not None:
+				bad = bad[:renderer.max_count]
+			renderer.submit(self.wavenums, 
+					self.intensities[bad], 
+					[f"{i}_{int(snr[i])}" for i in bad])
 	
+	def grid_positions(self):
+		"""
+		Calculates the (row, column) position of each spectrum on the map grid
+		"""
+
+		return self.grid.rows, self.grid.cols
+
+	@instrument.stage()
+	def fit_peaks(self, peaks, indices, workers=None, method="curve_fit", warm_start=True, progress=None,
+			full_output=False):
+		"""
+		Fits the bands of each of the given peaks for the given spectra, optionally spreading the
+		  work over a pool of processes (results are identical to serial fitting)
+
+		Parameters
+		----------
+		peaks: list of peak names (keys of material.peaks)
+		indices: indices of the spectra to fit
+		workers: number of worker processes, 1 fits serially and None picks one worker per chunk of
+		  FIT_CHUNK_SIZE spectra up to the number of CPUs (only used by the 'curve_fit' method)
+		method: 'curve_fit' fits each spectrum separately with fit_lorentzian, 'batch' fits every
+		  spectrum of a peak window at once with fit_lorentzian_batch (both fit a single Lorentzian
+		  per window), 'joint' fits every band of every window (of the material's shape) at once, in 
+		  a single optimization per spectrum batched across FIT_CHUNK_SIZE spectra with fit_bands_batch
+		warm_start: if True (and method is 'curve_fit') spectra are fitted in a serpentine raster
+		  order, each fit starting from the parameters of an already fitted neighbour
+		progress: optional callback, called as progress(stage, done, total) with the number of spectra
+		  fitted so far (an exception raised by the callback cancels the remaining fits)
+		full_output: if True the standard errors of the parameters are returned as well
+
+		Returns
+		----------
+		array of shape (len(indices), number of bands, number of shape parameters) holding the fitted
+		  amplitude, gamma and peak location (and any other shape parameter) of each band (NaN where 
+		  the fit failed to converge), and an array of the same shape holding their standard errors 
+		  if full_output
+		"""
+
+		windows = [self.index.peak_windows[k] for k in peaks]
+		indices = np.asarray(indices, dtype=int)
+
+		if method == "joint":
+			profile = PROFILES[self.material.shape]
+			locations = [list(self.material.bands[k].values()) for k in peaks]
+			shape = (len(indices), len(self.material.band_names(peaks)), profile.n_params)
+			params = np.full(shape, np.nan)
+			errors = np.full(shape, np.nan)
+			for start in range(0, len(indices), FIT_CHUNK_SIZE):
+				chunk = self.intensities[indices[start:start+FIT_CHUNK_SIZE]]
+				p, converged, e = fit_bands_batch([(self.wavenums[w], chunk[:, w]) for w in windows], 
+						locations, 
+						profile, 
+						full_output=True)
+				params[start:start+len(chunk)][converged] = p[converged]
+				errors[start:start+len(chunk)][converged] = e[converged]
+				if progress:
+					progress("Fitting peaks", start + len(chunk), len(indices))
+			return (params, errors) if full_output else params
+		elif method not in ("curve_fit", "batch"):
+			raise ValueError("Invalid method, must be 'curve_fit', 'batch' or 'joint'")
+		elif not self.material.single_bands(peaks):
+			raise ValueError("Peak windows holding several bands or non-Lorentzian bands need method 'joint'")
+
+		if method == "batch":
+			params = np.full((len(indices), len(peaks), 3), np.nan)
+			errors = np.full((len(indices), len(peaks), 3), np.nan)
+			for j, w in enumerate(windows):
+				p, converged, e = fit_lorentzian_batch(self.wavenums[w], 
+						self.intensities[:, w][indices], 
+						full_output=True)
+				params[converged, j] = p[converged]
+				errors[converged, j] = e[converged]
+				if progress:
+					progress(f"Fitting {peaks[j]} peaks", len(indices), len(indices))
+			return (params, errors) if full_output else params
+
+		order = np.arange(len(indices))
+		if warm_start:
+			# serpentine raster order (every other row reversed) so consecutive spectra are neighbours
+			order = self.grid.raster_order(indices)
+			rows, cols = self.grid.rows[indices], self.grid.cols[indices]
+
+		# only the peak windows of each chunk are shipped to the workers, chunks are kept in order so
+		#  the results can simply be concatenated
+		chunks = []
+		for start in range(0, len(order), FIT_CHUNK_SIZE):
+			o = order[start:start+FIT_CHUNK_SIZE]
+			chunk = self.intensities[indices[o]]
+			chunks.append(([(self.wavenums[w], chunk[:, w]) for w in windows], 
+				(rows[o], cols[o]) if warm_start else None))
+
+		if not chunks:
+			empty = np.full((0, len(peaks), 3), np.nan)
+			return (empty, empty.copy()) if full_output else empty
+
+		if workers is None:
+			workers = min(os.cpu_count() or 1, len(chunks))
+
+		results = []
+		if workers <= 1:
+			for c in chunks:
+				results.append(_fit_chunk(*c))
+				if progress:
+					progress("Fitting peaks", min(len(results) * FIT_CHUNK_SIZE, len(indices)), len(indices))
+		else:
+			pool = ProcessPoolExecutor(max_workers=workers)
+			try:
+				task = partial(_fit_chunk_remote, instrument.enabled())
+				for r, memoized, stats in pool.map(task, *zip(*chunks)):
+					# what the workers memoized and recorded is sent back with their results
+					fit_memo.update(memoized)
+					if stats:
+						instrument.merge(stats)
+					results.append(r)
+					if progress:
+						progress("Fitting peaks", min(len(results) * FIT_CHUNK_SIZE, len(indices)), len(indices))
+			finally:
+				# chunks that have not started yet are dropped when fitting is cancelled
+				pool.shutdown(cancel_futures=True)
+
+		fit_memo.flush()
+
+		# putting the results back in the order of indices
+		params = np.empty((len(indices), len(peaks), 3))
+		errors = np.empty((len(indices), len(peaks), 3))
+		params[order] = np.concatenate([p for p, e in results])
+		errors[order] = np.concatenate([e for p, e in results])
+		return (params, errors) if full_output else params
+
+	@instrument.stage()
+	def data_summary(self, thresh=15, savebad=None, workers=None, method="joint", warm_start=True, 
+			progress=None, refit=False):
+		"""
+		removes raman spectra that have a signal-to-noise ratio below the threshold, fits the bands of
+		  the remaining spectra and calculates their statistics
+
+		Parameters
+		----------
+		thresh: signal-to-noise threshold below which to exclude (default 15)
+		savebad: provides ability to save rejected spectra to assure the 
+		  threshold is set correctly (should be a path to a directory where you want to save the images)
+		workers: number of processes used for peak fitting (see RamanMap.fit_peaks)
+		method: peak fitting method, 'curve_fit', 'batch' or 'joint' (see RamanMap.fit_peaks)
+		warm_start: whether to start each fit from a neighbouring pixel's fit (see RamanMap.fit_peaks)
+		progress: optional progress callback (see RamanMap.fit_peaks), if it raises the spectra that
+		  were not fitted yet are marked as not present
+		refit: if True every present spectrum is fitted again, neither the results of earlier calls
+		  nor saved results are reused
+		"""
+
+		sc = self.spectra_characteristics
+
+		# spectra of lazily loaded maps are baseline-corrected and checked for noise first
+		self.process(progress)
+
+		# results of earlier calls (or saved results of earlier analyses) are reused, unless they were
+		#  fitted with different settings or a refit was asked for
+		if refit or self._fit_settings != (method, warm_start):
+			sc["fitted"] = False
+			sc["fit_failed"] = False
+			if refit or not (self.store and self.load_results(fit_settings=(method, warm_start))):
+				self._fit_settings = (method, warm_start)
+
+		self.remove_noisy(thresh, savebad)
+
+		# only spectra that have not been fitted yet (i.e. ones restored by a lower threshold) are fitted
+		indices = np.flatnonzero(sc["present"] & ~sc["fitted"])
+		try:
+			params, errors = self.fit_peaks(list(self.material.peaks), indices, workers, method, warm_start, 
+					progress, 
+					full_output=True)
+		except BaseException:
+			# when fitting is cancelled the spectra that were not fitted yet are left out, calling
+			#  data_summary again picks them up
+			sc["present"] &= sc["fitted"]
+			raise
+		self.fit_params[indices] = params
+		self.fit_errors[indices] = errors
+		sc["fitted"][indices] = True
+
+		failed = np.isnan(params).any(axis=(1, 2))
+		sc["present"][indices[failed]] = False
+		sc["fit_failed"][indices[failed]] = True
+		self._summarize(indices[~failed], params[~failed])
+
+		if self.store and len(indices):
+			self.save_results(thresh=thresh)
+
+	def _summarize(self, indices, params):
+		"""
+		Calculates the statistics of newly fitted spectra (the location, full width at half maximum and
+		  height of every band), subclasses calculating other statistics override this
+
+		Parameters
+		----------
+		indices: indices of the spectra
+		params: their fitted parameters, shape (len(indices), number of bands, number of shape parameters)
+		"""
+
+		sc = self.spectra_characteristics
+		profile = PROFILES[self.material.shape]
+		for j, band in enumerate(self.material.band_names()):
+			key = band_key(band)
+			sc[f"peak_loc_{key}"][indices] = params[:, j, 2]
+			sc[f"fwhm_{key}"][indices] = profile.fwhm(params[:, j])
+			sc[f"height_{key}"][indices] = profile.height(params[:, j])
+
+	@instrument.stage()
+	def category_statistics(self, savepath):
+		"""
+		Calculates summary statistics (mean, standard deviation, maximum and minimum over the present
+		  spectra) of every statistic
+		"""
+
+		data = {"Measurement": [],
+				"Mean": [],
+				"STDev": [],
+				"Max": [],
+				"Min": []}
+
+		sc = self.spectra_characteristics
+
+		for i in self.statistics:
+			d = summ_stats(sc[i][sc["present"]])
+			data["Measurement"].append(i)
+			data["Mean"].append(d["mean"])
+			data["STDev"].append(d["stdev"])
+			data["Max"].append(d["max"])
+			data["Min"].append(d["min"])
+
+		pd.DataFrame(data=data).to_csv(savepath, index=False)
+
+	@instrument.stage()
 	def create_heatmap(self, 
 			statistic,
 			savepath, 
@@ -105,12 +707,7 @@ class RamanMap:
 		gradient: number of steps between high and low colors on scale (default 10)
 		scale: if specified, hard limits of color bar scale (tuple if specified, otherwise autocalculated)
 		"""
-		xs = [d["x"] for d in self.spectra_characteristics]
-		ys = [d["y"] for d in self.spectra_characteristics]
-		incl = [d["present"] for d in self.spectra_characteristics]
-		scale_x = [int(round((i-self.min_x) / self.x_step, 0)) for i in xs]
-		scale_y = [int(round((i-self.min_y) / self.y_step, 0)) for i in ys]
-		ds = [d[statistic] for d in self.spectra_characteristics]
+		ds = self.spectra_characteristics[statistic]
 
 		if scale == "auto":
 			scale_bot = np.min(ds)
@@ -122,16 +719,14 @@ class RamanMap:
 			raise ValueError("Invalid type, 'scale' must be tuple")
 
 		stat_delta = (scale_top - scale_bot) / gradient
-		col_array = list(Color(start_color).range_to(Color(end_color), gradient))
+		lut = color_lut(start_color, end_color, gradient)
+		image_array = render_heatmap(self.grid.rows, 
+				self.grid.cols, 
+				self.grid.shape, 
+				color_bins(ds, scale_bot, stat_delta, len(lut)), 
+				lut)
 
-		image_array = np.zeros([self.unique_y, self.unique_x], dtype=(float, 3))
-
-		for x,y,d in zip(scale_x, scale_y, ds):
-			pix_color = col_array[find_index(d, scale_bot, stat_delta)].get_rgb()
-			pix_color_int = list(map(lambda x: int(x * 255), pix_color))
-			image_array[self.unique_y - y - 1][x] = pix_color_int
-
-		img = Image.fromarray(np.uint8(image_array), "RGB")
+		img = Image.fromarray(image_array, "RGB")
 
 		if size:
 			img = img.resize((size, int(size * self.aspect_ratio)), Image.NEAREST)
@@ -140,6 +735,7 @@ class RamanMap:
 
 		return img
 
+	@instrument.stage()
 	def create_histogram(self, statistic, unit, savepath, **kwargs):
 		"""
 		Creates a histogram for a given statistic
@@ -151,124 +747,124 @@ class RamanMap:
 		savepath: where to save the resulting plot to
 		kwargs: keyword arguments that will be used in the histogram
 		"""
-		vals = [d[statistic] for d in self.spectra_characteristics if d["present"]]
-		plt.hist(vals, **kwargs)
-		plt.xlabel(unit)
-		plt.ylabel("Count")
-		plt.savefig(savepath)
-		plt.close()
-
-	def average_spectrum(self, savepath):
+		sc = self.spectra_characteristics
+		vals = sc[statistic][sc["present"]]
+		# figures are created with the object-oriented Agg API rather than pyplot, so histograms can be
+		#  saved from a background thread while a GUI is running
+		fig = Figure()
+		FigureCanvasAgg(fig)
+		ax = fig.add_subplot()
+		ax.hist(vals, **kwargs)
+		ax.set_xlabel(unit)
+		ax.set_ylabel("Count")
+		fig.savefig(savepath)
+
+	@instrument.stage()
+	def average_spectrum(self, savepath=None, median=False, percentiles=None):
 		"""
 		Creates average Raman spectrum across map (only spectra that pass SNR test)
 
+		The mean and standard deviation are accumulated chunk by chunk, so they never need more than
+		  chunk_size spectra in memory (the median and percentiles need every present spectrum)
+
 		Parameters
 		----------
-		savepath: path to save image
-		"""
-
-		avg_spectrum = np.array([0 for i in self.spectra[0].intensities])
-		
-		for n, s in enumerate(self.spectra_characteristics):
-			if s["present"]:
-				spectrum = self.spectra[n]
-				for i, j in enumerate(spectrum.intensities):
-					avg_spectrum[i] += j
+		savepath: path to save image (the mean spectrum, with a band of one standard deviation or of
+		  the outermost percentiles), no image is created if None
+		median: whether to also calculate the median spectrum
+		percentiles: optional list of percentiles (between 0 and 100) to calculate at each wavenumber
 
-		avg_spectrum = avg_spectrum / len(self.spectra[0])
-		plt.plot(self.spectra[0].wavenums, avg_spectrum)
-		plt.xlabel("Wavenumber (cm^-1)")
-		plt.ylabel("Intensity (a.u.)")
-		plt.savefig(savepath)
-		plt.close()
-					
+		Returns
+		----------
+		dictionary holding the wavenums, the number of spectra averaged (count), the mean and std
+		  spectra, plus the median and a dictionary of percentile spectra if requested
+		"""
 
+		present = np.flatnonzero(self.spectra_characteristics["present"])
+
+		acc = SpectrumAccumulator()
+		for start in range(0, len(present), self.chunk_size):
+			acc.add(self.intensities[present[start:start+self.chunk_size]])
+
+		result = {"wavenums": self.wavenums, "count": acc.count, "mean": acc.mean, "std": acc.std}
+
+		if median or percentiles:
+			spectra = self.intensities[present]
+			if median:
+				result["median"] = np.median(spectra, axis=0)
+			if percentiles:
+				result["percentiles"] = dict(zip(percentiles, np.percentile(spectra, percentiles, axis=0)))
+
+		if savepath and acc.count:
+			fig = Figure()
+			FigureCanvasAgg(fig)
+			ax = fig.add_subplot()
+			ax.plot(self.wavenums, result["mean"])
+			if percentiles:
+				ax.fill_between(self.wavenums, 
+						result["percentiles"][min(percentiles)], 
+						result["percentiles"][max(percentiles)], 
+						alpha=0.3)
+			else:
+				ax.fill_between(self.wavenums, 
+						result["mean"] - result["std"], 
+						result["mean"] + result["std"], 
+						alpha=0.3)
+			ax.set_xlabel("Wavenumber (cm^-1)")
+			ax.set_ylabel("Intensity (a.u.)")
+			fig.savefig(savepath)
+
+		return result
 
 
 class GrapheneRamanMap(RamanMap):
-	def __init__(self, fpath, material):
+	statistics = ["peak_loc_d",
+			"peak_loc_g",
+			"peak_loc_2d",
+			"fwhm_2d",
+			"ratio_2dg",
+			"ratio_dg"]
+
+	def __init__(self, fpath, material, **kwargs):
 		"""
-		RamanMap specifically catering to Graphene, inherits from RamanMap class
+		RamanMap specifically catering to Graphene, inherits from RamanMap class (keyword arguments
+		  are passed on to RamanMap)
 		"""
 
-		super().__init__(fpath, GRAPHENE)
-
-		self.spectra_characteristics = [{"present": True,
-			"x": self.x[i],
-			"y": self.y[i],
-			"peak_loc_d": 0,
-			"peak_loc_g": 0,
-			"peak_loc_2d": 0,
-			"fwhm_2d": 0,
-			"ratio_2dg": 0,
-			"ratio_dg": 0} for i in range(len(self.spectra))]
+		super().__init__(fpath, material, **kwargs)
 	
-	def data_summary(self, thresh=15, savebad=None):
+	def data_summary(self, thresh=15, savebad=None, workers=None, method="curve_fit", warm_start=True, 
+			progress=None, refit=False):
 		"""
 		removes raman spectra that have a signal-to-noise ratio below the threshold, calculates
-		  graphene-specific statistics
-
-		Parameters
-		----------
-		thresh: signal-to-noise threshold below which to exclude (default 15)
-		savebad: provides ability to save rejected spectra to assure the 
-		  threshold is set correctly (should be a path to a directory where you want to save the images)
+		  graphene-specific statistics (see RamanMap.data_summary, peaks are fitted one window at a
+		  time by default)
 		"""
 
-		self.remove_noisy(thresh, savebad)
-		self.g_fits = []
-		
-		for n, s in enumerate(self.spectra_characteristics):
-			if s["present"]:
-				spectrum = self.spectra[n]
-				params_d = fit_lorentzian(*spectrum.peak_subsets["D"])
-				params_g = fit_lorentzian(*spectrum.peak_subsets["G"])
-				params_2d = fit_lorentzian(*spectrum.peak_subsets["2D"])
-
-				if any(i is None for i in [params_d, params_g, params_2d]):
-					s["present"] = False
-				else:
-					lor_d = lorentzian(spectrum.peak_subsets["D"], *params_d)
-					lor_g = lorentzian(spectrum.peak_subsets["G"], *params_g)
-					lor_2d = lorentzian(spectrum.peak_subsets["2D"], *params_2d)
-					self.g_fits.append(params_g)
-
-					s["peak_loc_d"] = params_d[2]
-					s["peak_loc_g"] = params_g[2]
-					s["peak_loc_2d"] = params_2d[2]
-					s["fwhm_2d"] = 2 * params_2d[1]
-					s["ratio_2dg"] = np.max(lor_2d) / np.max(lor_g)
-					s["ratio_dg"] = np.max(lor_d) / np.max(lor_g)
-	
-	def category_statistics(self, savepath):
+		super().data_summary(thresh, savebad, workers, method, warm_start, progress, refit)
+		self.g_fits = list(self.fit_params[self.spectra_characteristics["present"], 
+				self.material.band_names().index("G")])
+
+	def _summarize(self, indices, params):
 		"""
-		Calculates summary statistics for each graphene parameter of interest
+		Calculates the graphene statistics (D, G and 2D peak locations, 2D full width at half maximum,
+		  and 2D:G and D:G ratios of the fitted peak maxima) of newly fitted spectra
 		"""
 
-		categories = ["peak_loc_d",
-				"peak_loc_g",
-				"peak_loc_2d",
-				"fwhm_2d",
-				"ratio_2dg",
-				"ratio_dg"]
-
-		data = {"Measurement": [],
-				"Mean": [],
-				"STDev": [],
-				"Max": [],
-				"Min": []}
-
-		for i in categories:
-			d = summ_stats([j[i] for j in self.spectra_characteristics if j["present"]])
-			data["Measurement"].append(i)
-			data["Mean"].append(d["mean"])
-			data["STDev"].append(d["stdev"])
-			data["Max"].append(d["max"])
-			data["Min"].append(d["min"])
-
-		pd.DataFrame(data=data).to_csv(savepath, index=False)
-
-
+		sc = self.spectra_characteristics
+		profile = PROFILES[self.material.shape]
+		bands = self.material.band_names()
 
+		def peak(name):
+			params_band = params[:, bands.index(name)]
+			f, J = profile.model(self.wavenums[self.index.peak_windows[name]], params_band)
+			return params_band, np.max(f, axis=1)
 
+		(params_d, max_d), (params_g, max_g), (params_2d, max_2d) = peak("D"), peak("G"), peak("2D")
 
+		sc["peak_loc_d"][indices] = params_d[:, 2]
+		sc["peak_loc_g"][indices] = params_g[:, 2]
+		sc["peak_loc_2d"][indices] = params_2d[:, 2]
+		sc["fwhm_2d"][indices] = profile.fwhm(params_2d)
+		sc["ratio_2dg"][indices] = max_2d / max_g
+		sc["ratio_dg"][indices] = max_d / max_g
@@ -1,8 +1,10 @@
+from functools import cached_property
 import os
 
 import matplotlib.pyplot as plt
 import numpy as np
 
+from raman import instrument
 from raman.utils import baseline_als, fit_lorentzian, signal_noise_ratio, subset
 
 
@@ -15,33 +17,51 @@ class RamanSpectrum:
 	wavenums: wavenumbers of Raman spectrum
 	intensities: intensities of Raman spectrum
 	material: material to which the spectrum belongs
+	remove_baseline: whether to subtract the ALS baseline from the intensities (set to False when the
+	  intensities have already been baseline-corrected, i.e. by a RamanMap)
+	index: optional MaterialIndex of the wavenumber axis (i.e. shared by all spectra of a RamanMap),
+	  avoids looking up the peak and signal-to-noise windows again
 	"""
 
-	def __init__(self, wavenums, intensities, material):
+	@instrument.stage()
+	def __init__(self, wavenums, intensities, material, remove_baseline=True, index=None):
 		self.wavenums = wavenums
 		self.intensities = intensities
 
 		# subtracting baseline
-		self.intensities = self.intensities - baseline_als(self.intensities)
+		if remove_baseline:
+			self.intensities = self.intensities - baseline_als(self.intensities)
 
 		self.material = material
 		self.material_name = material.name
 		self.peaks = material.peaks
 		self.snr_sample_region = material.snr_sample_region
+		self.index = index
 
-		# calculating signal-to-noise ratio of spectrum
-		self.snr = signal_noise_ratio(self.wavenums,
+	@cached_property
+	def snr(self):
+		"""
+		Signal-to-noise ratio of the spectrum (calculated on first access)
+		"""
+
+		if self.index is not None:
+			return self.index.signal_noise_ratio(self.intensities)
+
+		return signal_noise_ratio(self.wavenums,
 				self.intensities,
 				*self.snr_sample_region)
-		
-		# dictionary for holding information about ranges of the spectrum containing peaks
-		self.peak_subsets = {}
-
-		for k,v  in self.peaks.items():
-			self.peak_subsets[k] = subset(self.wavenums, 
-					self.intensities, 
-					v[0], 
-					v[1])
+
+	@cached_property
+	def peak_subsets(self):
+		"""
+		Dictionary holding the ranges of the spectrum containing peaks, keys are peak names and values
+		  are (wavenumbers, intensities) tuples (calculated on first access)
+		"""
+
+		if self.index is not None:
+			return {k: self.index.peak(self.intensities, k) for k in self.peaks}
+
+		return {k: subset(self.wavenums, self.intensities, v[0], v[1]) for k, v in self.peaks.items()}
 	
 	def __len__(self):
 		"""
@@ -0,0 +1,161 @@
+from concurrent.futures import ProcessPoolExecutor, wait
+import math
+import os
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
+
+
+def _render_spectra(wavenums, intensities, paths, dpi):
+	"""
+	Renders one PNG per spectrum using the object-oriented Agg API (no pyplot global state, so it
+	  is safe to run in worker processes)
+
+	Parameters
+	----------
+	wavenums: wavenumber axis shared by every spectrum
+	intensities: 2-D array of intensities, one spectrum per row
+	paths: file path of each image
+	dpi: resolution of the images
+	"""
+
+	for y, path in zip(intensities, paths):
+		fig = Figure()
+		FigureCanvasAgg(fig)
+		fig.add_subplot().plot(wavenums, y)
+		fig.savefig(path, dpi=dpi)
+	return list(paths)
+
+def _render_montage(wavenums, intensities, titles, path, dpi, cols):
+	"""
+	Renders every spectrum into a single contact sheet image
+
+	Parameters
+	----------
+	wavenums: wavenumber axis shared by every spectrum
+	intensities: 2-D array of intensities, one spectrum per row
+	titles: title of each panel
+	path: file path of the image
+	dpi: resolution of the image
+	cols: number of panels per row
+	"""
+
+	rows = math.ceil(len(intensities) / cols)
+	fig = Figure(figsize=(2.5 * cols, 2 * rows))
+	FigureCanvasAgg(fig)
+	for n, (y, title) in enumerate(zip(intensities, titles)):
+		ax = fig.add_subplot(rows, cols, n + 1)
+		ax.plot(wavenums, y, linewidth=0.5)
+		ax.set_title(title, fontsize=8)
+		ax.tick_params(labelsize=6)
+	fig.tight_layout()
+	fig.savefig(path, dpi=dpi)
+	return [path]
+
+class BadSpectraRenderer:
+	def __init__(self, savedir, dpi=300, max_count=None, montage=False, montage_cols=8, workers=None,
+			chunk_size=16):
+		"""
+		Renders rejected spectra in the background on a pool of processes, so filtering does not
+		  wait for the images
+
+		Parameters
+		----------
+		savedir: directory to save the images to
+		dpi: resolution of the images (default 300)
+		max_count: maximum number of spectra to render (default all of them)
+		montage: if True a single contact sheet image (bad_spectra_montage.png) is created instead of
+		  one image per spectrum
+		montage_cols: number of spectra per row of the contact sheet
+		workers: number of worker processes (default number of CPUs)
+		chunk_size: number of spectra rendered per job
+		"""
+
+		self.savedir = savedir
+		self.dpi = dpi
+		self.max_count = max_count
+		self.montage = montage
+		self.montage_cols = montage_cols
+		self.workers = workers or os.cpu_count() or 1
+		self.chunk_size = chunk_size
+
+		self._pool = None
+		self.futures = []
+
+	def submit(self, wavenums, intensities, names):
+		"""
+		Queues spectra for rendering and returns immediately
+
+		Parameters
+		----------
+		wavenums: wavenumber axis shared by every spectrum
+		intensities: 2-D array of intensities, one spectrum per row
+		names: name of each spectrum (used as file name, or panel title of the contact sheet)
+		"""
+
+		names = list(names)
+		if self.max_count is not None:
+			names = names[:self.max_count]
+		if not names:
+			return
+
+		# the intensities are copied so only plain arrays (never memmaps) are sent to the workers
+		intensities = np.array(intensities[:len(names)])
+
+		if self._pool is None:
+			self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+		if self.montage:
+			self.futures.append(self._pool.submit(_render_montage,
+				wavenums,
+				intensities,
+				names,
+				os.path.join(self.savedir, "bad_spectra_montage.png"),
+				self.dpi,
+				self.montage_cols))
+		else:
+			paths = [os.path.join(self.savedir, f"{i}.png") for i in names]
+			for start in range(0, len(names), self.chunk_size):
+				self.futures.append(self._pool.submit(_render_spectra,
+					wavenums,
+					intensities[start:start+self.chunk_size],
+					paths[start:start+self.chunk_size],
+					self.dpi))
+
+	def done(self):
+		"""
+		Whether every queued image has been rendered
+		"""
+
+		return all(f.done() for f in self.futures)
+
+	def wait(self):
+		"""
+		Blocks until every queued image has been rendered, then shuts down the worker processes
+		  (the first error raised while rendering, i.e. an unwritable directory, is raised here)
+
+		Returns
+		----------
+		list of the paths of the rendered images
+		"""
+
+		futures, self.futures = self.futures, []
+		try:
+			wait(futures)
+			return [p for f in futures for p in f.result()]
+		finally:
+			self.shutdown()
+
+	def shutdown(self, wait=True):
+		"""
+		Shuts down the worker processes, images that are still queued are rendered first
+
+		Parameters
+		----------
+		wait: whether to block until the queued images have been rendered
+		"""
+
+		if self._pool is not None:
+			self._pool.shutdown(wait=wait)
+			self._pool = None
@@ -0,0 +1,91 @@
+import hashlib
+
+import numpy as np
+
+from raman import instrument
+from raman.npz import atomic_savez, load_keyed_npz
+
+# bumped whenever the layout of the results file changes so stale results are ignored
+RESULTS_VERSION = 1
+
+def results_path(fpath):
+	"""
+	Path of the results file belonging to a map file (stored next to the map)
+
+	Parameters
+	----------
+	fpath: file path to map data
+	"""
+
+	return f"{fpath}.results.npz"
+
+def spectrum_hashes(intensities, chunk_size=1024):
+	"""
+	Calculates a 64-bit hash of every spectrum, used to tell which spectra changed since their
+	  results were saved
+
+	Parameters
+	----------
+	intensities: 2-D array of intensities (one row per spectrum)
+	chunk_size: number of spectra read at a time (for memory-mapped maps)
+	"""
+
+	hashes = np.empty(len(intensities), dtype=np.uint64)
+	for start in range(0, len(intensities), chunk_size):
+		chunk = np.ascontiguousarray(intensities[start:start+chunk_size], dtype=float)
+		for i, row in enumerate(chunk):
+			hashes[start + i] = int.from_bytes(hashlib.blake2b(row.tobytes(), digest_size=8).digest(), "little")
+	return hashes
+
+def results_key(bline_params, material, statistics):
+	"""
+	Creates the dictionary identifying the analysis that produced a set of results (the map contents
+	  are checked spectrum by spectrum, see spectrum_hashes)
+
+	Parameters
+	----------
+	bline_params: dictionary of baseline parameters (lam, p, niter)
+	material: Material the map was analysed as
+	statistics: names of the per-spectrum statistics
+	"""
+
+	return {"version": RESULTS_VERSION,
+			"bline_params": {k: bline_params[k] for k in sorted(bline_params)},
+			"material": {"name": material.name,
+				"peaks": {k: list(v) for k, v in material.peaks.items()},
+				"snr_sample_region": list(material.snr_sample_region),
+				"bands": material.bands,
+				"shape": material.shape},
+			"statistics": list(statistics)}
+
+@instrument.stage()
+def load_results(path, key):
+	"""
+	Loads saved results if they exist and were produced by the same analysis
+
+	Parameters
+	----------
+	path: path of the results file
+	key: dictionary created by results_key
+
+	Returns
+	----------
+	header dictionary (key, fit settings and threshold) and dictionary of per-spectrum arrays, or
+	  None if there are no matching results
+	"""
+
+	return load_keyed_npz(path, key)
+
+@instrument.stage()
+def save_results(path, header, arrays):
+	"""
+	Saves results as one array per column (see atomic_savez)
+
+	Parameters
+	----------
+	path: path of the results file
+	header: dictionary created by results_key, plus any other settings to record
+	arrays: dictionary of per-spectrum arrays
+	"""
+
+	atomic_savez(path, header, arrays, compressed=True)
@@ -2,9 +2,13 @@ import datetime
 
 import numpy as np
 from scipy import sparse
+from scipy.linalg import solveh_banded
 from scipy.optimize import curve_fit
 from scipy.sparse.linalg import spsolve
 
+from raman import instrument
+from raman.memo import fit_memo
+
 def timestamp():
 	"""
 	Creates timestamp in format YYYYMMDD_HHMMSS (i.e. 20220206_113320)
@@ -12,16 +16,19 @@ def timestamp():
 
 	return datetime.datetime.now().strftime("%y%m%d_%H%M%S")
 
-def subset(wavenums, intensities, start_wavenum, end_wavenum):
+def subset_bounds(wavenums, start_wavenum, end_wavenum):
 	"""
-	Function that creates subset of array based on wavenums
+	Function that finds the index bounds of a wavenumber range (the range used by subset)
 
 	Parameters
 	----------
 	wavenums: numpy array holding wavenumbers of complete spectrum
-	intensities: numpy array holding intensities of complete spectrum
 	start_wavenum: wavenumber at beginning of peak of interest
 	end_wavenum: wavenumber at end of peak of interest
+
+	Returns
+	----------
+	start and (exclusive) end index of the range
 	"""
 
 	if start_wavenum < np.min(wavenums):
@@ -34,11 +41,27 @@ def subset(wavenums, intensities, start_wavenum, end_wavenum):
 	else:
 		end_index = np.argmax(wavenums >= end_wavenum)
 
+	return start_index, end_index
+
+def subset(wavenums, intensities, start_wavenum, end_wavenum):
+	"""
+	Function that creates subset of array based on wavenums
+
+	Parameters
+	----------
+	wavenums: numpy array holding wavenumbers of complete spectrum
+	intensities: numpy array holding intensities of complete spectrum
+	start_wavenum: wavenumber at beginning of peak of interest
+	end_wavenum: wavenumber at end of peak of interest
+	"""
+
+	start_index, end_index = subset_bounds(wavenums, start_wavenum, end_wavenum)
 	return wavenums[start_index:end_index], intensities[start_index:end_index]
 
 # borrowed from stackoverflow.com/questions/29156532
 # more about asymmetric least squares: https://pubs.rsc.org/en/content/articlehtml/2015/an/c4an01061b
-def baseline_als(y, lam=10000, p=0.001, niter=10):
+@instrument.stage()
+def baseline_als(y, lam=10000, p=0.001, niter=10, method="banded"):
 	"""
 	Removes baseline from Raman spectrum
 
@@ -47,24 +70,159 @@ def baseline_als(y, lam=10000, p=0.001, niter=10):
 	y: intensity spectrum
 	lam: smoothness parameter (lambda)
 	p: asymmetry parameter (recommended between 0.001 - 0.1)
-	niter: number of iterations to perform
+	niter: maximum number of iterations to perform (stops early once the weights stop changing)
+	method: linear solver to use, either 'banded' (banded Cholesky on the pentadiagonal system) or
+	  'sparse' (generic sparse solver)
 
 	Returns
 	----------
 	Input Raman spectrum with baseline removed
 	"""
 
+	if niter < 1:
+		raise ValueError("Invalid niter, must be at least 1")
+
+	y = np.asarray(y, dtype=float)
 	L = len(y)
-	D = sparse.diags([1, -2, 1], [0, -1, -2], shape=(L, L-2))
 	w = np.ones(L)
 
+	if method == "sparse":
+		D = sparse.diags([1, -2, 1], [0, -1, -2], shape=(L, L-2))
+		P = lam * D.dot(D.transpose())
+	elif method == "banded":
+		# the system is symmetric pentadiagonal, so only the upper bands are stored (in the layout
+		#  solveh_banded expects), the off-diagonals never change between iterations
+		diag, off1, off2 = _penalty_bands(L, lam)
+		ab = np.zeros((3, L))
+		ab[0, 2:] = off2
+		ab[1, 1:] = off1
+	else:
+		raise ValueError("Invalid method, must be 'banded' or 'sparse'")
+
 	for i in range(niter):
-		W = sparse.spdiags(w, 0, L, L)
-		Z = W + lam * D.dot(D.transpose())
-		z = spsolve(Z, w*y)
-		w = p * (y > z) + (1 - p) * (y < z)
+		if method == "sparse":
+			W = sparse.spdiags(w, 0, L, L)
+			Z = W + P
+			z = spsolve(Z.tocsc(), w*y)
+		else:
+			ab[2] = diag + w
+			z = solveh_banded(ab, w*y, check_finite=False)
+		w_new = p * (y > z) + (1 - p) * (y < z)
+
+		# once the weights stop changing every further iteration would give the same baseline
+		if np.array_equal(w_new, w):
+			break
+		w = w_new
 	return z
 
+def _penalty_bands(L, lam):
+	"""
+	Builds the non-zero diagonals of the ALS smoothness penalty lam * D.D^T, which only depends on
+	  the number of wavenumber samples and so can be shared across every spectrum of a map
+
+	Parameters
+	----------
+	L: number of wavenumber samples
+	lam: smoothness parameter (lambda)
+
+	Returns
+	----------
+	tuple of the main diagonal (length L), first off-diagonal (length L-1) and second
+	  off-diagonal (length L-2) of the symmetric pentadiagonal penalty matrix
+	"""
+
+	D = sparse.diags([1, -2, 1], [0, -1, -2], shape=(L, L-2))
+	P = lam * D.dot(D.transpose())
+	return P.diagonal(0), P.diagonal(1), P.diagonal(2)
+
+@instrument.stage()
+def baseline_als_batch(Y, lam=10000, p=0.001, niter=10):
+	"""
+	Computes the asymmetric least squares baselines of many spectra sharing one wavenumber axis in
+	  a single batched pass (see baseline_als for the single spectrum version)
+
+	Parameters
+	----------
+	Y: 2-D array of intensities, shape (number of spectra, number of wavenumbers)
+	lam: smoothness parameter (lambda)
+	p: asymmetry parameter (recommended between 0.001 - 0.1)
+	niter: maximum number of iterations to perform (spectra whose weights stop changing are
+	  dropped from further iterations)
+
+	Returns
+	----------
+	2-D array of baselines with the same shape as Y
+	"""
+
+	if niter < 1:
+		raise ValueError("Invalid niter, must be at least 1")
+
+	Y = np.asarray(Y, dtype=float)
+	N, L = Y.shape
+	diag, off1, off2 = _penalty_bands(L, lam)
+
+	# every spectrum's system is stacked into one block-diagonal banded system, the penalty bands
+	#  are shared so the off-diagonals are simply tiled (the leading zeros of each block keep the
+	#  blocks independent)
+	ab = np.zeros((3, N*L))
+	ab[0] = np.tile(np.concatenate(([0, 0], off2)), N)
+	ab[1] = np.tile(np.concatenate(([0], off1)), N)
+
+	w = np.ones_like(Y)
+	Z = np.empty_like(Y)
+
+	# spectra whose weights have stopped changing are dropped from later iterations
+	active = np.arange(N)
+
+	for i in range(niter):
+		if len(active) == 0:
+			break
+		n = len(active)
+		Ya = Y[active]
+		wa = w[active]
+		ab[2, :n*L] = (diag + wa).ravel()
+		Za = solveh_banded(ab[:, :n*L], (wa*Ya).ravel(), check_finite=False).reshape(n, L)
+		Z[active] = Za
+		w_new = p * (Ya > Za) + (1 - p) * (Ya < Za)
+		changed = np.any(w_new != wa, axis=1)
+		w[active] = w_new
+		active = active[changed]
+	return Z
+
+@instrument.stage()
+def remove_baseline(raw, out=None, chunk_size=1024, progress=None, dtype=float, **kwargs):
+	"""
+	Subtracts the ALS baseline from every spectrum of a 2-D intensity array, chunk by chunk so only
+	  chunk_size spectra are ever held in memory by the solver (useful for memory-mapped maps)
+
+	Parameters
+	----------
+	raw: 2-D array of intensities, shape (number of spectra, number of wavenumbers)
+	out: optional array of the same shape to write the corrected intensities into (may be raw
+	  itself for an in-place correction)
+	chunk_size: number of spectra corrected per batch
+	progress: optional callback, called as progress(stage, done, total) after every batch
+	dtype: data type of the corrected intensities when out is not given (i.e. np.float32 to halve
+	  their memory, baselines are always solved in float64)
+	kwargs: keyword arguments passed on to baseline_als_batch (lam, p, niter)
+
+	Returns
+	----------
+	2-D array of baseline-corrected intensities
+	"""
+
+	if out is None:
+		out = np.empty(raw.shape, dtype=dtype)
+
+	# the penalty of the baseline system is far too ill-conditioned for single precision, so each
+	#  chunk is promoted to float64 for the solve and only rounded when stored
+	for start in range(0, len(raw), chunk_size):
+		chunk = np.asarray(raw[start:start+chunk_size], dtype=float)
+		out[start:start+chunk_size] = chunk - baseline_als_batch(chunk, **kwargs)
+		if progress:
+			progress("Removing baselines", min(start + chunk_size, len(raw)), len(raw))
+	return out
+
 def lorentzian(x, amp, gamm, x_0):
 	"""
 	Calculates Lorentzian (Cauchy) Distribution with the given parameters
@@ -83,7 +241,8 @@ def lorentzian(x, amp, gamm, x_0):
 
 	return (amp/(np.pi*gamm)) * ((gamm**2)/(((x-x_0)**2)+(gamm**2)))
 
-def fit_lorentzian(x, y, p0=(2000,2000,1600)):
+@instrument.stage()
+def fit_lorentzian(x, y, p0=(2000,2000,1600), full_output=False, memo=True):
 	"""
 	Fits a single lorentzian distribution to a peak (using the lorentzian function)
 
@@ -92,20 +251,242 @@ def fit_lorentzian(x, y, p0=(2000,2000,1600)):
 	x: x-axis data (wavenumbers)
 	y: y-axis data (intensity)
 	p0: tuple containing initial guesses for amplitude, full width half maximum, and peak location
+	full_output: if True the standard errors of the parameters (square root of the diagonal of the
+	  covariance matrix, inf where the covariance could not be estimated) are returned as well
+	memo: whether to memoize the result by the contents of x, y and p0 (see raman.memo.fit_memo),
+	  fitting the same data again then returns the earlier result without refitting
 
 	Returns
 	----------
-	best fit of amplitude, full width half maximum, and peak location
+	best fit of amplitude, full width half maximum, and peak location (and their standard errors if
+	  full_output), or None if the fit did not converge
 	"""
 
-	try:
-		return curve_fit(lorentzian, x, y, p0=p0)[0]
-	except RuntimeError:
-		# if the max number of iterations is exceeded, a RuntimeError will be created, here this is
-		#  just ignored and the point is not filled in on the heatmap
-		print("Failed to converge")
+	def fit():
+		try:
+			popt, pcov, info, mesg, ier = curve_fit(lorentzian, x, y, p0=p0, full_output=True)
+			instrument.count("fit_lorentzian", "evaluations", info["nfev"])
+			return np.concatenate([popt, np.sqrt(np.abs(np.diag(pcov)))])
+		except RuntimeError:
+			# if the max number of iterations is exceeded, a RuntimeError will be created, here this is
+			#  only counted and the point is not filled in on the heatmap
+			instrument.count("fit_lorentzian", "failures")
+			return None
+
+	if memo and fit_memo.enabled:
+		found, result = fit_memo.lookup(fit_memo.key("lorentzian/curve_fit", x, y, p0), fit)
+		if found:
+			instrument.count("fit_lorentzian", "memo_hits")
+	else:
+		result = fit()
+
+	if result is None:
 		return None
+	if full_output:
+		return result[:3].copy(), result[3:].copy()
+	return result[:3].copy()
+
+def guess_lorentzian(x, y):
+	"""
+	Makes data-driven initial guesses of Lorentzian parameters for one or many spectra (peak
+	  location at the maximum, width from the number of samples above half maximum)
+
+	Parameters
+	----------
+	x: x-axis data (wavenumbers)
+	y: y-axis data (intensity), either 1-D or 2-D with one spectrum per row
+
+	Returns
+	----------
+	array of initial guesses for amplitude, gamma and peak location (shape (3,) or (N, 3))
+	"""
+
+	x = np.asarray(x, dtype=float)
+	y = np.asarray(y, dtype=float)
+	Y = np.atleast_2d(y)
+	dx = np.abs(np.mean(np.diff(x)))
+
+	peak = np.argmax(Y, axis=1)
+	height = Y[np.arange(len(Y)), peak]
+	x_0 = x[peak]
+
+	# full width at half maximum estimated from the number of samples above half the peak height
+	fwhm = np.count_nonzero(Y >= height[:, None] / 2, axis=1) * dx
+	gamm = np.clip(fwhm / 2, dx, np.ptp(x))
+	amp = height * np.pi * gamm
+
+	p0 = np.stack([amp, gamm, x_0], axis=1)
+	return p0[0] if y.ndim == 1 else p0
+
+def lorentzian_jacobian(x, P):
+	"""
+	Calculates Lorentzians (see lorentzian) of many parameter sets and their partial derivatives
+	  with respect to each parameter
+
+	Parameters
+	----------
+	x: x-axis data (wavenumbers)
+	P: array of amplitudes, gammas and peak locations of shape (N, 3)
+
+	Returns
+	----------
+	array of shape (N, len(x)) holding the Lorentzians and array of shape (N, len(x), 3) holding
+	  their derivatives with respect to amplitude, gamma and peak location
+	"""
+
+	amp, gamm, x_0 = P[:, 0, None], P[:, 1, None], P[:, 2, None]
+	u = x - x_0
+	den = u**2 + gamm**2
+	f = amp * gamm / (np.pi * den)
+
+	J = np.stack([gamm / (np.pi * den),
+		amp * (u**2 - gamm**2) / (np.pi * den**2),
+		2 * amp * gamm * u / (np.pi * den**2)], axis=2)
+	return f, J
+
+def levenberg_marquardt(model, Y, params, max_iter=100, tol=1e-8, ftol=1.49012e-08, bounds=None, 
+		full_output=False):
+	"""
+	Fits the same model to many spectra simultaneously, using Levenberg-Marquardt steps vectorized
+	  across spectra (each spectrum has its own damping and converges on its own)
+
+	Parameters
+	----------
+	model: function of an (N, P) array of parameters returning the model (N, M) and its Jacobian 
+	  (N, M, P)
+	Y: 2-D array of y-axis data (intensity), one spectrum per row
+	params: initial parameters, shape (N, P)
+	max_iter: maximum number of iterations
+	tol: relative change in parameters below which a fit is considered converged
+	ftol: relative reduction of the sum of squares below which a fit is considered converged (like
+	  curve_fit, catches fits creeping along a flat valley i.e. between overlapping bands)
+	bounds: optional (lower, upper) arrays of parameter bounds (of shape (P,)), parameters at a
+	  bound are held there while the cost keeps pushing them out
+	full_output: if True the standard errors of the parameters are returned as well (from the
+	  covariance matrix estimated like curve_fit does, inverse of JtJ scaled by the residual variance)
+
+	Returns
+	----------
+	array of best fit parameters (shape (N, P)), boolean mask of which spectra converged, number of
+	  iterations (and array of standard errors of shape (N, P) if full_output)
+	"""
+
+	params = np.array(params, dtype=float)
+	N, n_params = params.shape
+	if bounds is not None:
+		lower, upper = bounds
+		params = np.clip(params, lower, upper)
 
+	f, J = model(params)
+	cost = np.sum((Y - f)**2, axis=1)
+	damping = np.full(N, 1e-3)
+	converged = np.zeros(N, dtype=bool)
+	active = np.arange(N)
+
+	for i in range(max_iter):
+		if len(active) == 0:
+			break
+
+		r = Y[active] - f[active]
+		Ja = J[active]
+		Jt = Ja.transpose(0, 2, 1)
+		JtJ = Jt @ Ja
+		g = (Jt @ r[..., None])[..., 0]
+
+		# damping scaled by the diagonal so each parameter is stepped according to its own scale (with a
+		#  floor, so parameters the model does not depend on, i.e. the width of a band with no
+		#  amplitude, do not make the system singular)
+		diag = np.diagonal(JtJ, axis1=1, axis2=2)
+		diag = np.maximum(diag, 1e-12 * np.max(diag, axis=1, keepdims=True))
+		A = JtJ + (damping[active, None] * diag)[..., None] * np.eye(n_params)
+
+		if bounds is not None:
+			# parameters at a bound the gradient pushes against are left out of the step
+			P = params[active]
+			held = ((P <= lower) & (g < 0)) | ((P >= upper) & (g > 0))
+			A = np.where(held[:, :, None] | held[:, None, :], 0, A) + held[:, :, None] * np.eye(n_params)
+			g = np.where(held, 0, g)
+		with np.errstate(all="ignore"):
+			try:
+				step = np.linalg.solve(A, g[..., None])[..., 0]
+			except np.linalg.LinAlgError:
+				step = np.stack([np.linalg.lstsq(a, b, rcond=None)[0] for a, b in zip(A, g)])
+
+			trial = params[active] + step
+			if bounds is not None:
+				trial = np.clip(trial, lower, upper)
+				step = trial - params[active]
+			f_trial, J_trial = model(trial)
+			cost_trial = np.sum((Y[active] - f_trial)**2, axis=1)
+
+		better = np.isfinite(cost_trial) & (cost_trial <= cost[active])
+		with np.errstate(all="ignore"):
+			flat = cost[active] - cost_trial <= ftol * cost[active]
+		accepted = active[better]
+		params[accepted] = trial[better]
+		f[accepted] = f_trial[better]
+		J[accepted] = J_trial[better]
+		cost[accepted] = cost_trial[better]
+		damping[accepted] /= 10
+		damping[active[~better]] *= 10
+
+		# a fit has converged when an accepted step no longer changes the parameters or the cost
+		small = np.all(np.abs(step) <= tol * (np.abs(params[active]) + tol), axis=1) | flat
+		done = (better & small) | (damping[active] > 1e12)
+		converged[active[better & small]] = True
+		active = active[~done]
+
+	converged &= np.all(np.isfinite(params), axis=1)
+	iterations = i + 1 if max_iter else 0
+
+	if full_output:
+		JtJ = J.transpose(0, 2, 1) @ J
+		dof = max(Y.shape[1] - n_params, 1)
+		with np.errstate(all="ignore"):
+			cov = np.linalg.pinv(JtJ) * (cost / dof)[:, None, None]
+			errors = np.sqrt(np.abs(np.diagonal(cov, axis1=1, axis2=2)))
+		return params, converged, iterations, errors
+	return params, converged, iterations
+
+@instrument.stage()
+def fit_lorentzian_batch(x, Y, p0=None, max_iter=100, tol=1e-8, full_output=False):
+	"""
+	Fits a single lorentzian distribution to the same peak window of many spectra simultaneously,
+	  using Levenberg-Marquardt steps with an analytic Jacobian vectorized across spectra
+
+	Parameters
+	----------
+	x: x-axis data (wavenumbers) shared by every spectrum
+	Y: 2-D array of y-axis data (intensity), one spectrum per row
+	p0: initial guesses for amplitude, gamma and peak location, shape (N, 3) (default uses
+	  guess_lorentzian)
+	max_iter: maximum number of iterations
+	tol: relative change in parameters below which a fit is considered converged
+	full_output: if True the standard errors of the parameters are returned as well (see
+	  levenberg_marquardt)
+
+	Returns
+	----------
+	array of best fit amplitude, gamma and peak location (shape (N, 3)), boolean mask of which
+	  spectra converged (and array of standard errors of shape (N, 3) if full_output)
+	"""
+
+	x = np.asarray(x, dtype=float)
+	Y = np.asarray(Y, dtype=float)
+	N = len(Y)
+
+	params = guess_lorentzian(x, Y) if p0 is None else np.array(p0, dtype=float).reshape(N, 3)
+
+	result = levenberg_marquardt(lambda P: lorentzian_jacobian(x, P), Y, params, max_iter, tol,
+			full_output=full_output)
+	instrument.count("fit_lorentzian_batch", "iterations", result[2])
+	instrument.count("fit_lorentzian_batch", "failures", int(np.sum(~result[1])))
+
+	if full_output:
+		return result[0], result[1], result[3]
+	return result[0], result[1]
+
+@instrument.stage()
 def signal_noise_ratio(wavenums, intensities, start_wavenum, end_wavenum):
 	"""
 	Calculates the signal to noise ratio of a spectrum
@@ -127,6 +508,62 @@ def signal_noise_ratio(wavenums, intensities, start_wavenum, end_wavenum):
 		start_wavenum, 
 		end_wavenum)[1])
 
+class SpectrumAccumulator:
+	def __init__(self):
+		"""
+		Streaming accumulator of the mean and standard deviation of many spectra, spectra can be
+		  added chunk by chunk (i.e. from a memory-mapped map) and are never stored
+
+		Chunks are merged with the pairwise update of Chan et al., which stays accurate when the
+		  number of spectra is large
+		"""
+
+		self.count = 0
+		self._mean = None
+		self._m2 = None
+
+	def add(self, chunk):
+		"""
+		Adds a chunk of spectra
+
+		Parameters
+		----------
+		chunk: 2-D array of intensities, one spectrum per row
+		"""
+
+		chunk = np.asarray(chunk, dtype=float)
+		n = len(chunk)
+		if n == 0:
+			return
+
+		mean = np.mean(chunk, axis=0)
+		m2 = np.sum((chunk - mean)**2, axis=0)
+
+		if self.count == 0:
+			self._mean, self._m2 = mean, m2
+		else:
+			total = self.count + n
+			delta = mean - self._mean
+			self._mean = self._mean + delta * n / total
+			self._m2 = self._m2 + m2 + delta**2 * self.count * n / total
+		self.count += n
+
+	@property
+	def mean(self):
+		"""
+		Mean spectrum of everything added so far
+		"""
+
+		return self._mean
+
+	@property
+	def std(self):
+		"""
+		Standard deviation at each wavenumber of everything added so far
+		"""
+
+		return np.sqrt(self._m2 / self.count) if self.count else None
+
 def find_index(x, min_val, delta, max_=None):
 	"""
 	Finds index of given value in evenly spaced array 
@@ -0,0 +1,113 @@
+import queue
+import threading
+import time
+
+
+class Cancelled(Exception):
+	"""
+	Raised inside a background job when it has been cancelled
+	"""
+
+class Job:
+	def __init__(self, target, *args, **kwargs):
+		"""
+		Runs a long task (loading, filtering or analysing a map) on a background thread so the GUI
+		  stays responsive
+
+		The task must accept a progress keyword argument, which it calls as progress(stage, done, total).
+		  Every call puts a message on a thread-safe queue (read it from the GUI thread with poll()),
+		  and raises Cancelled once cancel() has been called
+
+		Parameters
+		----------
+		target: function to run
+		args: positional arguments passed on to target
+		kwargs: keyword arguments passed on to target
+		"""
+
+		self.target = target
+		self.args = args
+		self.kwargs = kwargs
+
+		self.queue = queue.Queue()
+		self._cancel = threading.Event()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+
+		# time and number of items done at the first report of the current stage (for rate and ETA)
+		self._stage = None
+		self._stage_start = 0.0
+		self._stage_done = 0
+
+	def start(self):
+		"""
+		Starts the task on a background thread
+		"""
+
+		self._thread.start()
+		return self
+
+	def cancel(self):
+		"""
+		Asks the task to stop, it does so the next time it reports progress
+		"""
+
+		self._cancel.set()
+
+	@property
+	def cancelled(self):
+		return self._cancel.is_set()
+
+	def progress(self, stage, done, total, unit="pixels"):
+		"""
+		Progress callback handed to the task, queues a ('progress', stage, done, total, unit, rate, eta)
+		  message where rate is in units per second and eta in seconds (None until it can be estimated)
+
+		Parameters
+		----------
+		stage: description of what is being done
+		done: number of items (i.e. spectra) done so far in this stage
+		total: total number of items in this stage
+		unit: name of the items (default pixels, i.e. spectra of the map)
+		"""
+
+		if self._cancel.is_set():
+			raise Cancelled()
+
+		now = time.perf_counter()
+		if stage != self._stage:
+			self._stage = stage
+			self._stage_start = now
+			self._stage_done = done
+
+		elapsed = now - self._stage_start
+		rate = (done - self._stage_done) / elapsed if elapsed > 0 and done > self._stage_done else None
+		eta = (total - done) / rate if rate else None
+		self.queue.put(("progress", stage, done, total, unit, rate, eta))
+
+	def _run(self):
+		try:
+			result = self.target(*self.args, progress=self.progress, **self.kwargs)
+		except Cancelled:
+			self.queue.put(("cancelled",))
+		except Exception as e:
+			self.queue.put(("error", e))
+		else:
+			self.queue.put(("done", result))
+
+	def poll(self):
+		"""
+		Returns every message queued since the last call without blocking (call this from the GUI
+		  thread, i.e. with tkinter's after())
+
+		Returns
+		----------
+		list of message tuples, the last one is ('done', result), ('cancelled',) or ('error', exception)
+		  once the task has finished
+		"""
+
+		messages = []
+		while True:
+			try:
+				messages.append(self.queue.get_nowait())
+			except queue.Empty:
+				return messages